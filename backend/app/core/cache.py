@@ -2,12 +2,21 @@
 Redis cache management
 """
 import json
+import sqlite3
+import threading
+from pathlib import Path
+import numpy as np
 import redis.asyncio as redis
+from scipy import sparse
 from typing import Optional, Any
 from app.core.config import get_settings
+from app.core.logging import log
 
 settings = get_settings()
 
+# Default location of the persistent query-vector cache (gitignored app data dir)
+EMBEDDING_CACHE_PATH = Path(__file__).resolve().parents[2] / "data" / "nlp_cache" / "query_vectors.sqlite3"
+
 
 class CacheManager:
     """Async Redis cache manager"""
@@ -93,5 +102,94 @@ class CacheManager:
             return 0
 
 
+class EmbeddingCache:
+    """
+    Persistent SQLite cache of sparse TF-IDF query rows keyed by a content
+    hash. Callers fold the model/vocabulary signature into the key so entries
+    invalidate themselves when the vectorizer is refitted. Rows are stored as
+    raw indices/data arrays (never pickled); once the table grows past
+    ``max_rows`` the oldest rows are evicted down to 90% of it.
+    """
+    
+    def __init__(self, path: Optional[str] = None, max_rows: Optional[int] = None):
+        self._lock = threading.Lock()
+        self._max_rows = max_rows or settings.embedding_cache_max_rows
+        self._conn: Optional[sqlite3.Connection] = None
+        self._rows = 0
+        db_path = Path(path or settings.embedding_cache_path or EMBEDDING_CACHE_PATH)
+        try:
+            db_path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(db_path), check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS query_rows "
+                "(key BLOB PRIMARY KEY, n_features INTEGER, indices BLOB, data BLOB)"
+            )
+            conn.commit()
+            self._rows = conn.execute("SELECT COUNT(*) FROM query_rows").fetchone()[0]
+            self._conn = conn
+        except Exception as e:
+            # A broken cache must never break recommendations; run uncached
+            log.debug(f"Embedding cache disabled ({db_path}): {e}")
+    
+    def get(self, key: bytes) -> Optional[sparse.csr_matrix]:
+        """Get a cached (1, n_features) CSR row"""
+        if self._conn is None:
+            return None
+        try:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT n_features, indices, data FROM query_rows WHERE key = ?", (key,)
+                ).fetchone()
+            if row is None:
+                return None
+            n_features, indices, data = row
+            indices = np.frombuffer(indices, dtype=np.int32)
+            data = np.frombuffer(data, dtype=np.float32)
+            return sparse.csr_matrix(
+                (data, indices, np.array([0, len(indices)], dtype=np.int32)),
+                shape=(1, n_features)
+            )
+        except Exception as e:
+            log.debug(f"Embedding cache read failed: {e}")
+            return None
+    
+    def put(self, key: bytes, value: sparse.spmatrix) -> None:
+        """Cache a single-row sparse matrix"""
+        if self._conn is None:
+            return
+        try:
+            value = sparse.csr_matrix(value)
+            indices = value.indices.astype(np.int32, copy=False).tobytes()
+            data = value.data.astype(np.float32, copy=False).tobytes()
+            with self._lock:
+                inserted = self._conn.execute(
+                    "INSERT OR IGNORE INTO query_rows (key, n_features, indices, data) VALUES (?, ?, ?, ?)",
+                    (key, value.shape[1], indices, data)
+                ).rowcount
+                if inserted:
+                    self._rows += 1
+                else:
+                    # Existing key: overwrite in place (keeps its age, doesn't grow the table)
+                    self._conn.execute(
+                        "UPDATE query_rows SET n_features = ?, indices = ?, data = ? WHERE key = ?",
+                        (value.shape[1], indices, data, key)
+                    )
+                if self._rows > self._max_rows:
+                    # Evict in one chunk down to 90% of the cap, so this runs once
+                    # per ~max_rows/10 inserts rather than on every write at capacity.
+                    # Rowids grow with every insert, so the lowest are the oldest
+                    evict = self._rows - int(self._max_rows * 0.9)
+                    self._rows -= self._conn.execute(
+                        "DELETE FROM query_rows WHERE rowid IN "
+                        "(SELECT rowid FROM query_rows ORDER BY rowid LIMIT ?)",
+                        (evict,)
+                    ).rowcount
+                self._conn.commit()
+        except Exception as e:
+            log.debug(f"Embedding cache write failed: {e}")
+
+
 # Global cache instance
 cache = CacheManager()
@@ -72,8 +72,29 @@ class Settings(BaseSettings):
     embedding_model: str = "sentence-transformers/all-MiniLM-L6-v2"  # 80MB instead of 420MB
     vector_dimension: int = 384  # MiniLM uses 384 dimensions
     top_k_results: int = 10
+    # Queries embedded at startup (JSON list in env); repeats of these skip the embedding call
+    rag_warmup_queries: List[str] = [
+        "I am hiring for Java developers who can also collaborate effectively with my business teams"
+    ]
     model_loading_timeout: int = 60  # seconds
     
+    # Persistent TF-IDF query-vector cache (empty = backend/data/nlp_cache/query_vectors.sqlite3)
+    embedding_cache_path: str = ""
+    embedding_cache_max_rows: int = 50000  # Oldest rows are evicted past this
+    
+    # ChromaDB persistent store (empty = backend/data/chromadb), shared by ingestion and serving
+    chroma_persist_dir: str = ""
+    
+    # ChromaDB HNSW index (small, read-mostly collection: spend build time for query speed)
+    hnsw_m: int = 24
+    hnsw_ef_construction: int = 128
+    hnsw_ef_search: int = 100  # Comfortably above any n_results we request, even under filters
+    hnsw_num_threads: int = 4
+    
+    # Supabase vector table snapshot kept in memory between searches (seconds, 0 = refetch every search).
+    # This is the only refresh: re-ingested rows become visible once it lapses
+    vector_table_cache_ttl: int = 3600
+    
     # Recommendation Configuration
     default_recommendation_engine: str = "hybrid"
     max_recommendations: int = 10
@@ -90,6 +111,10 @@ class Settings(BaseSettings):
     gemini_model: str = "gemini-2.5-flash"
     gemini_temperature: float = 0.7
     gemini_max_tokens: int = 2048
+    gemini_batch_size: int = 8  # Max concurrent requests coalesced per call (1 disables)
+    gemini_batch_max_wait_ms: int = 20  # How long to wait for a batch to fill
+    gemini_hedge_enabled: bool = False  # Fire a duplicate call when the first is slow
+    gemini_hedge_after_ms: int = 4000  # ~p95 Gemini latency; hedge delay
     
     def validate_production_settings(self) -> None:
         """Validate that required settings are configured for production"""
@@ -3,13 +3,22 @@ Vector Database Abstraction Layer
 Supports both ChromaDB (local) and Supabase pgvector (cloud)
 """
 import os
+import json
+import time
 import logging
+import threading
 from typing import List, Dict, Any, Optional, Tuple
 from pathlib import Path
 from abc import ABC, abstractmethod
+import numpy as np
+
+from app.core.config import get_settings
 
 log = logging.getLogger(__name__)
 
+# Supabase columns that results (metadata + document) are built from
+_RESULT_COLUMNS = "name,url,description,duration,adaptive_support,remote_support,test_type,job_level,full_text"
+
 
 class VectorDB(ABC):
     """Abstract base class for vector database operations"""
@@ -25,7 +34,7 @@ class VectorDB(ABC):
         Search for similar vectors
         
         Args:
-            query_embedding: Query vector
+            query_embedding: Query vector (list or ndarray)
             n_results: Number of results to return
             filters: Optional metadata filters
             
@@ -34,6 +43,20 @@ class VectorDB(ABC):
         """
         pass
     
+    def search_many(
+        self, 
+        query_embeddings: List[List[float]], 
+        n_results: int = 10,
+        filters: Optional[Dict[str, Any]] = None
+    ) -> List[Tuple[List[Dict[str, Any]], List[str]]]:
+        """
+        Search for several query vectors with the same filters
+        
+        Returns:
+            One (metadatas, documents) tuple per query, in query order
+        """
+        return [self.search(query_embedding, n_results, filters) for query_embedding in query_embeddings]
+    
     @abstractmethod
     def get_all(self) -> Tuple[List[Dict[str, Any]], List[str]]:
         """
@@ -50,34 +73,48 @@ class VectorDB(ABC):
         pass
 
 
+def chroma_persist_path() -> Path:
+    """Directory of the persistent ChromaDB store"""
+    return Path(get_settings().chroma_persist_dir or Path(__file__).parent.parent.parent / "data" / "chromadb")
+
+
+def chroma_client():
+    """PersistentClient on the shared store, so the HNSW index survives restarts"""
+    import chromadb
+    from chromadb.config import Settings as ChromaSettings
+    
+    # No product telemetry calls on startup or per operation
+    return chromadb.PersistentClient(path=str(chroma_persist_path()), settings=ChromaSettings(anonymized_telemetry=False))
+
+
+def chroma_collection_metadata() -> Dict[str, Any]:
+    """Metadata (distance + HNSW parameters) for the assessments collection"""
+    settings = get_settings()
+    return {
+        "hnsw:space": "ip",  # Embeddings are L2-normalized, so inner product ranks like cosine
+        "hnsw:M": settings.hnsw_m,
+        "hnsw:construction_ef": settings.hnsw_ef_construction,
+        "hnsw:search_ef": settings.hnsw_ef_search,
+        "hnsw:num_threads": settings.hnsw_num_threads
+    }
+
+
 class ChromaDBBackend(VectorDB):
     """ChromaDB implementation for local development"""
     
     def __init__(self):
-        import chromadb
-        
-        base_dir = Path(__file__).parent.parent.parent
-        db_path = base_dir / "data" / "chromadb"
-        
-        log.info(f"Connecting to ChromaDB at {db_path}")
-        self.client = chromadb.PersistentClient(path=str(db_path))
-        
-        # Get or create collection
-        existing_collections = self.client.list_collections()
-        exists = any(c.name == "shl_assessments" for c in existing_collections)
+        log.info(f"Connecting to ChromaDB at {chroma_persist_path()}")
+        self.client = chroma_client()
         
-        if not exists:
-            log.warning("Collection 'shl_assessments' not found. Creating...")
-            self.collection = self.client.create_collection(
-                "shl_assessments", 
-                metadata={"hnsw:space": "cosine"}
-            )
-        else:
-            self.collection = self.client.get_collection(name="shl_assessments")
+        # Get or create collection in one call (no collection listing)
+        self.collection = self.client.get_or_create_collection(
+            name="shl_assessments", 
+            metadata=chroma_collection_metadata()
+        )
         
         count = self.collection.count()
         if count == 0:
-            log.warning("ChromaDB collection is empty. Run ingestion first.")
+            log.warning("ChromaDB collection 'shl_assessments' is empty. Run ingestion first.")
         else:
             log.info(f"Connected to ChromaDB with {count} items")
     
@@ -88,24 +125,47 @@ class ChromaDBBackend(VectorDB):
         filters: Optional[Dict[str, Any]] = None
     ) -> Tuple[List[Dict[str, Any]], List[str]]:
         """Search using ChromaDB"""
-        where_filter = None
-        if filters:
-            # Convert filters to ChromaDB format
-            where_filter = {}
-            for key, value in filters.items():
-                if value is not None:
-                    where_filter[key] = value
-        
+        return self.search_many(np.asarray(query_embedding, dtype=np.float32).reshape(1, -1), n_results, filters)[0]
+    
+    def search_many(
+        self, 
+        query_embeddings: List[List[float]], 
+        n_results: int = 10,
+        filters: Optional[Dict[str, Any]] = None
+    ) -> List[Tuple[List[Dict[str, Any]], List[str]]]:
+        """Search several query vectors in one ChromaDB query call"""
         results = self.collection.query(
-            query_embeddings=[query_embedding],
+            query_embeddings=np.asarray(query_embeddings, dtype=np.float32).reshape(len(query_embeddings), -1),  # No list round-trip
             n_results=n_results,
-            where=where_filter if where_filter else None
+            where=self._where(filters),
+            include=["metadatas", "documents"]  # Distances are never read
         )
         
-        metadatas = results['metadatas'][0] if results['metadatas'] else []
-        documents = results['documents'][0] if results['documents'] else []
+        all_metadatas = results['metadatas'] or [[] for _ in query_embeddings]
+        all_documents = results['documents'] or [[] for _ in query_embeddings]
         
-        return metadatas, documents
+        return list(zip(all_metadatas, all_documents))
+    
+    @staticmethod
+    def _where(filters: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """Convert metadata filters to a ChromaDB where clause, applied inside the HNSW search"""
+        if not filters:
+            return None
+        
+        clauses = []
+        for key, value in filters.items():
+            if value is None:
+                continue
+            if key == 'max_duration':
+                # Stored duration is an int; 0 means unknown and is kept (like the post-filter)
+                clauses.append({'duration': {'$lte': int(value)}})
+            else:
+                clauses.append({key: value})
+        
+        # Chroma takes a single condition per clause; several must be combined with $and
+        if not clauses:
+            return None
+        return clauses[0] if len(clauses) == 1 else {'$and': clauses}
     
     def get_all(self) -> Tuple[List[Dict[str, Any]], List[str]]:
         """Get all documents from ChromaDB"""
@@ -126,6 +186,13 @@ class SupabaseVectorBackend(VectorDB):
         self.db = get_supabase_client()
         self.table_name = "assessment_embeddings"
         
+        # In-memory snapshot of the (small, read-mostly) table: rows, embedding matrix and filter columns.
+        # Ingestion runs in a separate process, so the snapshot is refreshed by
+        # TTL only: re-ingested rows show up within vector_table_cache_ttl
+        self._table: Optional[Dict[str, Any]] = None
+        self._table_loaded_at = 0.0
+        self._table_lock = threading.Lock()
+        
         # Verify table exists (non-blocking - just warn if fails)
         try:
             result = self.db.table(self.table_name).select("id").limit(1).execute()
@@ -135,6 +202,67 @@ class SupabaseVectorBackend(VectorDB):
             log.warning(f"Could not verify Supabase table '{self.table_name}': {e}")
             log.warning("Table may not exist or connection may be slow. Queries will fail until this is resolved.")
     
+    def _get_table(self) -> Dict[str, Any]:
+        """Table snapshot, refetched once it is older than the configured TTL"""
+        ttl = get_settings().vector_table_cache_ttl
+        table = self._table
+        if table is not None and time.monotonic() - self._table_loaded_at < ttl:
+            return table
+        
+        with self._table_lock:
+            # Another thread may have refreshed it while we waited
+            if self._table is not None and time.monotonic() - self._table_loaded_at < ttl:
+                return self._table
+            table = self._load_table()
+            self._table = table
+            self._table_loaded_at = time.monotonic()
+            return table
+    
+    def _load_table(self) -> Dict[str, Any]:
+        """Fetch every row once and parse embeddings and filter columns into arrays"""
+        # The Supabase Python client doesn't support vector similarity ordering,
+        # so rows are ranked in Python against this snapshot
+        result = self.db.table(self.table_name).select(f"{_RESULT_COLUMNS},embedding").execute()
+        
+        rows = []
+        vectors = []
+        for row in result.data or []:
+            if row.get('embedding'):
+                # Supabase returns embeddings as lists already (from JSON)
+                embed_data = row['embedding']
+                if isinstance(embed_data, str):
+                    # If it's a string, parse it
+                    embed_data = json.loads(embed_data)
+                rows.append(row)
+                vectors.append(embed_data)
+        
+        doc_matrix = np.array(vectors, dtype=np.float32)
+        log.info(f"Loaded {len(rows)} rows from Supabase table '{self.table_name}'")
+        return {
+            'rows': rows,
+            'matrix': doc_matrix,
+            'norms': np.linalg.norm(doc_matrix, axis=1) if rows else np.zeros(0, dtype=np.float32),
+            'job_level': np.array([row.get('job_level') for row in rows], dtype=object),
+            # NULL durations never pass a max_duration filter (same as SQL comparison)
+            'duration': np.array([row['duration'] if row.get('duration') is not None else np.nan for row in rows], dtype=np.float64),
+            'remote_support': np.array([row.get('remote_support') for row in rows], dtype=object),
+            'adaptive_support': np.array([row.get('adaptive_support') for row in rows], dtype=object),
+        }
+    
+    def _filter_mask(self, table: Dict[str, Any], filters: Optional[Dict[str, Any]]) -> np.ndarray:
+        """Boolean row mask equivalent to the metadata filters"""
+        mask = np.ones(len(table['rows']), dtype=bool)
+        if filters:
+            if filters.get('job_level'):
+                mask &= table['job_level'] == filters['job_level']
+            if filters.get('max_duration'):
+                mask &= table['duration'] <= filters['max_duration']
+            if filters.get('remote_support'):
+                mask &= table['remote_support'] == filters['remote_support']
+            if filters.get('adaptive_support'):
+                mask &= table['adaptive_support'] == filters['adaptive_support']
+        return mask
+    
     def search(
         self, 
         query_embedding: List[float], 
@@ -144,86 +272,46 @@ class SupabaseVectorBackend(VectorDB):
         """
         Search using Supabase pgvector
         
-        Uses direct SQL query with vector similarity
+        Ranks the cached table snapshot by vector similarity
         """
+        return self.search_many([query_embedding], n_results, filters)[0]
+    
+    def search_many(
+        self, 
+        query_embeddings: List[List[float]], 
+        n_results: int = 10,
+        filters: Optional[Dict[str, Any]] = None
+    ) -> List[Tuple[List[Dict[str, Any]], List[str]]]:
+        """Rank the filtered rows of the cached table snapshot for several query vectors"""
         try:
-            # Convert embedding to PostgreSQL array format
-            embedding_str = '[' + ','.join(map(str, query_embedding)) + ']'
-            
-            # Build base query with filters
-            query_builder = self.db.table(self.table_name).select("*")
-            
-            # Apply metadata filters
-            if filters:
-                if filters.get('job_level'):
-                    query_builder = query_builder.eq('job_level', filters['job_level'])
-                if filters.get('max_duration'):
-                    query_builder = query_builder.lte('duration', filters['max_duration'])
-                if filters.get('remote_support'):
-                    query_builder = query_builder.eq('remote_support', filters['remote_support'])
-                if filters.get('adaptive_support'):
-                    query_builder = query_builder.eq('adaptive_support', filters['adaptive_support'])
-            
-            # For now, get all filtered results and sort in Python
-            # This is a workaround since the Supabase Python client doesn't support
-            # vector similarity ordering directly
-            result = query_builder.execute()
+            table = self._get_table()
             
-            if not result.data:
+            # Apply metadata filters; only rows with a non-zero embedding norm can be ranked
+            candidates = np.flatnonzero(self._filter_mask(table, filters) & (table['norms'] > 0))
+            if not len(candidates):
                 log.warning("No results from Supabase query")
-                return [], []
+                return [([], []) for _ in query_embeddings]
             
-            # Calculate cosine similarity in Python for now
-            # (ideally this would be done in the database, but client limitations)
-            import numpy as np
-            import json
+            rows = table['rows']
+            doc_matrix = table['matrix'][candidates]
+            doc_norms = table['norms'][candidates]
+            query_matrix = np.asarray(query_embeddings, dtype=np.float32).reshape(len(query_embeddings), -1)
+            dot_products = query_matrix @ doc_matrix.T
+            query_norms = np.linalg.norm(query_matrix, axis=1)
             
-            query_vec = np.array(query_embedding, dtype=np.float32)
-            scored_results = []
-            
-            for row in result.data:
-                if row.get('embedding'):
-                    # Supabase returns embeddings as lists already (from JSON)
-                    embed_data = row['embedding']
-                    if isinstance(embed_data, str):
-                        # If it's a string, parse it
-                        embed_data = json.loads(embed_data)
-                    
-                    doc_vec = np.array(embed_data, dtype=np.float32)
-                    
-                    # Cosine similarity
-                    dot_product = np.dot(query_vec, doc_vec)
-                    norm_product = np.linalg.norm(query_vec) * np.linalg.norm(doc_vec)
-                    if norm_product > 0:
-                        similarity = dot_product / norm_product
-                        scored_results.append((similarity, row))
-            
-            # Sort by similarity (highest first)
-            scored_results.sort(key=lambda x: x[0], reverse=True)
-            
-            # Take top n_results
-            top_results = scored_results[:n_results]
-            
-            # Convert to ChromaDB-compatible format
-            metadatas = []
-            documents = []
-            
-            for similarity, row in top_results:
-                metadata = {
-                    'name': row['name'],
-                    'url': row['url'],
-                    'description': row.get('description', ''),
-                    'duration': row.get('duration', 0),
-                    'adaptive_support': row.get('adaptive_support', 'No'),
-                    'remote_support': row.get('remote_support', 'No'),
-                    'test_type': row.get('test_type', 'General'),
-                    'job_level': row.get('job_level', 'General')
-                }
-                metadatas.append(metadata)
-                documents.append(row['full_text'])
-            
-            log.info(f"Supabase vector search returned {len(metadatas)} results")
-            return metadatas, documents
+            results = []
+            for dots, query_norm in zip(dot_products, query_norms):
+                if query_norm == 0:
+                    results.append(([], []))
+                    continue
+                # Cosine similarity, highest first (stable on ties)
+                similarities = dots / (doc_norms * query_norm)
+                top = candidates[np.argsort(-similarities, kind='stable')[:n_results]]
+                
+                metadatas, documents = self._rows_to_results([rows[i] for i in top])
+                log.info(f"Supabase vector search returned {len(metadatas)} results")
+                results.append((metadatas, documents))
+            return results
             
         except Exception as e:
             log.error(f"Supabase vector search failed: {e}")
@@ -232,51 +320,37 @@ class SupabaseVectorBackend(VectorDB):
             
             # Fallback to basic query without vector search
             try:
-                result = self.db.table(self.table_name).select("*").limit(n_results).execute()
-                metadatas = []
-                documents = []
-                
-                for row in result.data:
-                    metadata = {
-                        'name': row['name'],
-                        'url': row['url'],
-                        'description': row.get('description', ''),
-                        'duration': row.get('duration', 0),
-                        'adaptive_support': row.get('adaptive_support', 'No'),
-                        'remote_support': row.get('remote_support', 'No'),
-                        'test_type': row.get('test_type', 'General'),
-                        'job_level': row.get('job_level', 'General')
-                    }
-                    metadatas.append(metadata)
-                    documents.append(row['full_text'])
-                
+                result = self.db.table(self.table_name).select(_RESULT_COLUMNS).limit(n_results).execute()
+                metadatas, documents = self._rows_to_results(result.data)
                 log.warning(f"Using fallback: returned {len(metadatas)} random results")
-                return metadatas, documents
+                return [(metadatas, documents) for _ in query_embeddings]
             except Exception as fallback_error:
                 log.error(f"Fallback query also failed: {fallback_error}")
-                return [], []
+                return [([], []) for _ in query_embeddings]
+    
+    def _rows_to_results(self, rows: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[str]]:
+        """Convert table rows to ChromaDB-compatible (metadatas, documents)"""
+        # One comprehension per column instead of lockstep appends
+        metadatas = [{
+            'name': row['name'],
+            'url': row['url'],
+            'description': row.get('description', ''),
+            'duration': row.get('duration', 0),
+            'adaptive_support': row.get('adaptive_support', 'No'),
+            'remote_support': row.get('remote_support', 'No'),
+            'test_type': row.get('test_type', 'General'),
+            'job_level': row.get('job_level', 'General')
+        } for row in rows]
+        documents = [row['full_text'] for row in rows]
+        
+        return metadatas, documents
     
     def get_all(self) -> Tuple[List[Dict[str, Any]], List[str]]:
         """Get all documents from Supabase"""
         try:
-            result = self.db.table(self.table_name).select("*").execute()
-            
-            metadatas = []
-            documents = []
-            
-            for row in result.data:
-                metadata = {
-                    'name': row['name'],
-                    'url': row['url'],
-                    'description': row.get('description', ''),
-                    'duration': row.get('duration', 0),
-                    'adaptive_support': row.get('adaptive_support', 'No'),
-                    'remote_support': row.get('remote_support', 'No'),
-                    'test_type': row.get('test_type', 'General'),
-                    'job_level': row.get('job_level', 'General')
-                }
-                metadatas.append(metadata)
-                documents.append(row['full_text'])
+            # Only the columns the results are built from - not the embeddings
+            result = self.db.table(self.table_name).select(_RESULT_COLUMNS).execute()
+            metadatas, documents = self._rows_to_results(result.data)
             
             return metadatas, documents
             
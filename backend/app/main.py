@@ -1,6 +1,7 @@
 from fastapi import FastAPI, HTTPException, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
 import logging
+import asyncio
 from contextlib import asynccontextmanager
 import io
 import pypdf
@@ -25,13 +26,15 @@ async def lifespan(app: FastAPI):
     log.info("Starting up... app is ready to accept connections")
     
     # Initialize recommender in background (non-blocking)
-    import asyncio
-    
     async def init_recommender():
         global recommender
         log.info("Initializing recommender in background...")
         try:
-            recommender = EnhancedHybridRecommender()
+            # Construction and index warmup block on network/model loading, so
+            # keep them off the event loop; publish only once fully warm
+            instance = await asyncio.to_thread(EnhancedHybridRecommender)
+            await asyncio.to_thread(instance.warmup)
+            recommender = instance
             log.info("✅ Recommender initialized successfully")
         except Exception as e:
             log.error(f"⚠️ Failed to initialize recommender: {e}")
@@ -56,6 +59,32 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+def _fetch_url_text(url: str) -> str:
+    """Fetch a page and return its visible text, truncated for embedding"""
+    resp = requests.get(url, timeout=10, headers={"User-Agent": "Mozilla/5.0"})
+    resp.raise_for_status()
+    
+    # Parse HTML
+    soup = BeautifulSoup(resp.content, 'html.parser')
+    
+    # Remove non-content elements
+    for script in soup(["script", "style", "nav", "footer", "header", "aside"]):
+        script.decompose()
+        
+    # Extract text
+    text = soup.get_text(separator=' ', strip=True)
+    
+    # Truncate to reasonable length for embedding (e.g. 4000 chars)
+    return text[:4000]
+
+def _extract_pdf_text(content: bytes) -> str:
+    """Extract the text of every page of a PDF"""
+    reader = pypdf.PdfReader(io.BytesIO(content))
+    text = ""
+    for page in reader.pages:
+        text += page.extract_text() + "\n"
+    return text
+
 @app.get("/health", response_model=HealthCheck)
 async def health_check():
     status = "healthy" if recommender else "initializing"
@@ -73,22 +102,8 @@ async def get_recommendations(request: RecommendationRequest):
         if request.url:
             log.info(f"Fetching content from URL: {request.url}")
             try:
-                # Fetch URL content
-                resp = requests.get(request.url, timeout=10, headers={"User-Agent": "Mozilla/5.0"})
-                resp.raise_for_status()
-                
-                # Parse HTML
-                soup = BeautifulSoup(resp.content, 'html.parser')
-                
-                # Remove non-content elements
-                for script in soup(["script", "style", "nav", "footer", "header", "aside"]):
-                    script.decompose()
-                    
-                # Extract text
-                text = soup.get_text(separator=' ', strip=True)
-                
-                # Truncate to reasonable length for embedding (e.g. 4000 chars)
-                query_text = text[:4000]
+                # Fetch and parse off the event loop
+                query_text = await asyncio.to_thread(_fetch_url_text, request.url)
                 log.info(f"Extracted {len(query_text)} chars from URL")
                 
             except Exception as e:
@@ -99,8 +114,8 @@ async def get_recommendations(request: RecommendationRequest):
         if not query_text:
             raise HTTPException(status_code=400, detail="Either 'query' or 'url' must be provided")
 
-        # Get recommendations
-        results = recommender.recommend(query_text)
+        # Get recommendations (blocking HTTP/DB work runs in a worker thread)
+        results = await asyncio.to_thread(recommender.recommend, query_text)
         
         # ✅ Validate response
         num_recommendations = len(results.get('recommended_assessments', []))
@@ -126,7 +141,7 @@ async def chat(request: ChatRequest):
     try:
         # Convert Pydantic models to dicts for the service
         history_dicts = [h.model_dump() for h in request.history]
-        response_text = recommender.chat(request.message, history_dicts)
+        response_text = await asyncio.to_thread(recommender.chat, request.message, history_dicts)
         return {"response": response_text}
     except Exception as e:
         log.error(f"Error processing chat request: {e}")
@@ -140,13 +155,9 @@ async def recommend_pdf(file: UploadFile = File(...)):
     try:
         # Read file content
         content = await file.read()
-        pdf_file = io.BytesIO(content)
         
-        # Parse PDF
-        reader = pypdf.PdfReader(pdf_file)
-        text = ""
-        for page in reader.pages:
-            text += page.extract_text() + "\n"
+        # Parse PDF off the event loop
+        text = await asyncio.to_thread(_extract_pdf_text, content)
             
         # Limit text length to avoid token limits (approx 1000 words or 4000 chars)
         text = text[:4000]
@@ -154,7 +165,7 @@ async def recommend_pdf(file: UploadFile = File(...)):
         log.info(f"Extracted {len(text)} chars from PDF")
         
         # Use extracted text as query
-        results = recommender.recommend(text)
+        results = await asyncio.to_thread(recommender.recommend, text)
         return results
     except Exception as e:
         log.error(f"Error processing PDF: {e}")
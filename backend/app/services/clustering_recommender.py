@@ -1,12 +1,17 @@
 """
 Clustering-based recommendation engine using K-Means and PCA
 """
+import asyncio
+import os
 from typing import List, Dict
 import numpy as np
+from scipy.spatial import cKDTree
 from sklearn.cluster import KMeans
 from sklearn.preprocessing import StandardScaler
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.decomposition import PCA
+from sklearn.decomposition import IncrementalPCA
+from sklearn.utils import gen_batches
+from threadpoolctl import threadpool_limits
 
 from app.models.schemas import RecommendationRequest, RecommendationItem, RecommendationScore, AssessmentResponse
 from app.core.logging import log
@@ -17,16 +22,26 @@ class ClusteringRecommender:
     Clustering-based recommender using K-Means and PCA for dimensionality reduction
     """
     
-    def __init__(self, n_clusters: int = 10):
+    def __init__(self, n_clusters: int = 10, pca_batch_size: int = 256, fit_threads: int = None):
         """Initialize clustering recommender"""
         self.n_clusters = n_clusters
+        self.pca_batch_size = pca_batch_size
+        self.fit_threads = fit_threads or min(4, os.cpu_count() or 1)
         self.kmeans = None
         self.pca_reducer = None  # Changed from umap_reducer to pca_reducer
         self.scaler = StandardScaler()
         self.vectorizer = TfidfVectorizer(max_features=500, ngram_range=(1, 2))
         self.assessments_cache = []
         self.cluster_labels = None
-        self.feature_matrix = None
+        self.reduced_features = None  # Fit-time projection of every assessment
+        self._tfidf_dim = 0
+        self._query_buf = None  # Reused (1, d) row for query features
+        self._trees = {}  # cluster -> cKDTree over member features
+        self._cluster_idx_map = {}  # cluster -> global assessment indices
+        self._remote_mask = None  # Aligned with assessments_cache
+        self._duration = None  # Minutes, 0 when unknown
+        self._response_cache = []  # AssessmentResponse per assessments_cache index
+        self._fit_lock = asyncio.Lock()  # Serializes the lazy cold-start fit
     
     def _create_features(self, assessment: dict) -> str:
         """Create feature representation"""
@@ -42,21 +57,41 @@ class ClusteringRecommender:
     
     def fit(self, db):
         """Fit clustering model"""
-        log.info("Fitting clustering recommender")
+        # PCA's BLAS calls are threaded natively; make sure they get more than
+        # one thread even if the deploy env pins OPENBLAS/MKL_NUM_THREADS to 1.
+        # threadpoolctl limits are process-wide while active, so the scope is
+        # kept to BLAS and to the fit only (KMeans manages its own OpenMP
+        # threads)
+        with threadpool_limits(limits=self.fit_threads, user_api="blas"):
+            self._fit(db)
+    
+    def _fit(self, db):
+        """Fit clustering model (runs under the fit thread limits)
+
+        Everything is built in locals and published together at the end,
+        ``kmeans`` last: ``recommend`` treats ``kmeans is not None`` as
+        "fitted" without taking the lock, so it must never observe a
+        half-built model.
+        """
+        log.info(f"Fitting clustering recommender ({self.fit_threads} threads)")
         
         response = db.table("assessments").select("*").execute()
         assessments = response.data
-        self.assessments_cache = assessments
         
         if not assessments:
+            self.assessments_cache = []
             log.warning("No assessments found")
             return
         
+        # Response DTOs are built once here; recommend only attaches scores
+        response_cache = self._db_to_responses(assessments)
+        
         # Create feature documents
         documents = [self._create_features(a) for a in assessments]
         
-        # Create TF-IDF features
-        tfidf_features = self.vectorizer.fit_transform(documents).toarray()
+        # Create TF-IDF features (kept sparse; densified per batch below)
+        vectorizer = TfidfVectorizer(max_features=500, ngram_range=(1, 2))
+        tfidf_features = vectorizer.fit_transform(documents)
         
         # Add numerical features
         numerical_features = []
@@ -70,37 +105,86 @@ class ClusteringRecommender:
             ]
             numerical_features.append(features)
         
+        scaler = StandardScaler()
         numerical_features = np.array(numerical_features)
-        numerical_features = self.scaler.fit_transform(numerical_features)
+        numerical_features = scaler.fit_transform(numerical_features)
+        
+        # Filter attributes as aligned arrays so recommend can mask candidates
+        # before scoring them
+        remote_mask = np.array([bool(a.get('remote_testing')) for a in assessments], dtype=bool)
+        duration = np.array([a.get('duration') or 0 for a in assessments], dtype=np.int32)
         
-        # Combine features
-        self.feature_matrix = np.hstack([tfidf_features, numerical_features])
+        def dense_batch(sl: slice) -> np.ndarray:
+            """Dense TF-IDF + numerical rows for one slice of assessments"""
+            return np.hstack([tfidf_features[sl].toarray(), numerical_features[sl]])
         
-        # Dimensionality reduction with PCA (much faster than UMAP)
+        n_samples = len(assessments)
+        tfidf_dim = tfidf_features.shape[1]
+        n_features = tfidf_dim + numerical_features.shape[1]
+        
+        # Preallocate the query row so _create_query_features writes slices
+        # instead of hstack-ing a fresh array per request. float64 matches the
+        # dense batches PCA/KMeans are fitted on.
+        query_buf = np.empty((1, n_features), dtype=np.float64)
+        
+        # Dimensionality reduction with IncrementalPCA over dense batches, so
+        # peak memory is O(batch * d) rather than O(n * d)
+        pca_reducer = None
         try:
-            if len(assessments) > self.n_clusters and self.feature_matrix.shape[1] > 10:
-                # Use PCA for fast dimensionality reduction
-                n_components = min(50, len(assessments) - 1, self.feature_matrix.shape[1] - 1)
-                log.info(f"Starting PCA reduction: {self.feature_matrix.shape[0]} -> {n_components} dims")
+            if n_samples > self.n_clusters and n_features > 10:
+                n_components = min(50, n_samples - 1, n_features - 1)
+                log.info(f"Starting PCA reduction: {n_samples} -> {n_components} dims")
                 
-                self.pca_reducer = PCA(
+                pca_reducer = IncrementalPCA(
                     n_components=n_components,
-                    random_state=42
+                    batch_size=self.pca_batch_size
                 )
-                reduced_features = self.pca_reducer.fit_transform(self.feature_matrix)
-                log.info(f"✅ PCA completed in <1s: {self.feature_matrix.shape[0]} -> {reduced_features.shape[1]} dimensions")
+                for sl in gen_batches(n_samples, self.pca_batch_size, min_batch_size=n_components):
+                    pca_reducer.partial_fit(dense_batch(sl))
+                reduced_features = np.vstack([
+                    pca_reducer.transform(dense_batch(sl))
+                    for sl in gen_batches(n_samples, self.pca_batch_size)
+                ])
+                log.info(f"✅ PCA completed: {n_samples} -> {reduced_features.shape[1]} dimensions")
             else:
-                reduced_features = self.feature_matrix
+                reduced_features = dense_batch(slice(None))
                 log.info("Skipping PCA reduction (insufficient data)")
         except Exception as e:
             log.warning(f"PCA reduction failed: {e}, using original features")
-            reduced_features = self.feature_matrix
-            self.pca_reducer = None
+            reduced_features = dense_batch(slice(None))
+            pca_reducer = None
         
         # Clustering
         n_clusters = min(self.n_clusters, len(assessments), len(assessments) // 2 + 1)
-        self.kmeans = KMeans(n_clusters=n_clusters, random_state=42, n_init='auto')
-        self.cluster_labels = self.kmeans.fit_predict(reduced_features)
+        kmeans = KMeans(n_clusters=n_clusters, random_state=42, n_init='auto')
+        cluster_labels = kmeans.fit_predict(reduced_features)
+        
+        # Per-cluster KD-trees for within-cluster nearest-neighbour lookup
+        cluster_idx_map = {
+            c: np.where(cluster_labels == c)[0] for c in range(n_clusters)
+        }
+        trees = {
+            c: cKDTree(reduced_features[members])
+            for c, members in cluster_idx_map.items()
+            if len(members)
+        }
+        
+        # Publish. Stored features are projected once above and indexed
+        # directly at query time; the unprojected matrix is not kept.
+        self.assessments_cache = assessments
+        self._response_cache = response_cache
+        self.vectorizer = vectorizer
+        self.scaler = scaler
+        self._remote_mask = remote_mask
+        self._duration = duration
+        self._tfidf_dim = tfidf_dim
+        self._query_buf = query_buf
+        self.pca_reducer = pca_reducer
+        self.cluster_labels = cluster_labels
+        self.reduced_features = reduced_features
+        self._cluster_idx_map = cluster_idx_map
+        self._trees = trees
+        self.kmeans = kmeans
         
         log.info(f"✅ Clustering fitted with {n_clusters} clusters on {len(assessments)} assessments")
     
@@ -132,14 +216,16 @@ class ClusteringRecommender:
         ]
         numerical_features = self.scaler.transform([numerical])
         
-        # Combine
-        combined = np.hstack([tfidf_features, numerical_features])
+        # Combine into the preallocated row (no intermediate hstack copy)
+        self._query_buf[0, :self._tfidf_dim] = tfidf_features[0]
+        self._query_buf[0, self._tfidf_dim:] = numerical_features[0]
         
-        # Apply PCA if fitted
+        # Apply PCA if fitted; otherwise hand back a copy so callers never
+        # hold a view of the shared buffer
         if self.pca_reducer:
-            combined = self.pca_reducer.transform(combined)
+            return self.pca_reducer.transform(self._query_buf)
         
-        return combined
+        return self._query_buf.copy()
     
     async def recommend(
         self, 
@@ -149,10 +235,19 @@ class ClusteringRecommender:
         """
         Generate recommendations using clustering
         """
-        log.info(f"Clustering recommendation for: {request.dict()}")
+        log.opt(lazy=True).debug("Clustering recommendation for: {}", lambda: request.model_dump())
         
         if self.kmeans is None:
-            self.fit(db)
+            # Fit in a worker thread so the event loop keeps serving; the lock
+            # stops concurrent first requests from fitting twice
+            async with self._fit_lock:
+                if self.kmeans is None:
+                    await asyncio.to_thread(self.fit, db)
+        
+        # Language is request-level: only English assessments are stored
+        if request.language and request.language not in ['English']:
+            log.info(f"Clustering returned 0 recommendations (language {request.language} unavailable)")
+            return []
         
         # Create query features
         query_features = self._create_query_features(request)
@@ -161,52 +256,49 @@ class ClusteringRecommender:
         query_cluster = self.kmeans.predict(query_features)[0]
         log.info(f"Query assigned to cluster {query_cluster}")
         
-        # Get assessments in same cluster
-        cluster_indices = np.where(self.cluster_labels == query_cluster)[0]
-        
-        # Calculate distances within cluster
-        cluster_assessments = [(idx, self.assessments_cache[idx]) for idx in cluster_indices]
+        cluster_indices = self._cluster_idx_map.get(query_cluster, np.empty(0, dtype=int))
         
-        # Calculate distances to cluster center
-        cluster_center = self.kmeans.cluster_centers_[query_cluster]
+        # Apply filters as a vectorized mask over cluster members
+        keep = np.ones(len(cluster_indices), dtype=bool)
+        if request.remote_testing_required:
+            keep &= self._remote_mask[cluster_indices]
+        if request.max_duration:
+            durations = self._duration[cluster_indices]
+            keep &= (durations == 0) | (durations <= request.max_duration)
         
         scored_assessments = []
-        for idx, assessment in cluster_assessments:
-            # Get assessment features
-            if self.pca_reducer:
-                assessment_features = self.pca_reducer.transform(self.feature_matrix[idx:idx+1])
+        if keep.any():
+            k = min(request.num_recommendations, int(keep.sum()))
+            if keep.all():
+                distances, local_idx = self._trees[query_cluster].query(query_features[0], k=k)
+                local_idx = np.atleast_1d(local_idx)
+                distances = np.atleast_1d(distances)
             else:
-                assessment_features = self.feature_matrix[idx:idx+1]
-            
-            # Calculate distance to query
-            distance = np.linalg.norm(query_features - assessment_features)
-            similarity = 1 / (1 + distance)
+                # Score only the surviving members
+                local_idx = np.flatnonzero(keep)
+                member_features = self.reduced_features[cluster_indices[local_idx]]
+                distances = np.linalg.norm(member_features - query_features[0], axis=1)
+                # Partial selection of the k closest, then order just those
+                if k < len(distances):
+                    top = np.argpartition(distances, k - 1)[:k]
+                else:
+                    top = np.arange(len(distances))
+                top = top[np.argsort(distances[top])]
+                local_idx, distances = local_idx[top], distances[top]
             
-            scored_assessments.append((assessment, similarity, idx))
-        
-        # Sort by similarity
-        scored_assessments.sort(key=lambda x: x[1], reverse=True)
+            # Distance -> similarity for all hits in one array op
+            similarities = 1.0 / (1.0 + distances)
+            indices = cluster_indices[local_idx]
+            scored_assessments = [
+                (self.assessments_cache[idx], similarity, idx)
+                for idx, similarity in zip(indices.tolist(), similarities.tolist())
+            ]
         
         # Create recommendations
         recommendations = []
         
         for assessment, similarity, idx in scored_assessments:
-            if len(recommendations) >= request.num_recommendations:
-                break
-            
-            # Apply filters
-            if request.remote_testing_required and not assessment.get('remote_testing', False):
-                continue
-            
-            if request.max_duration and assessment.get('duration') and assessment.get('duration', 0) > request.max_duration:
-                continue
-            
-            if request.language:
-                languages = ['English']
-                if request.language not in languages:
-                    continue
-            
-            assessment_response = self._db_to_response(assessment)
+            assessment_response = self._response_cache[idx]
             
             score = RecommendationScore(
                 total_score=similarity,
@@ -224,21 +316,29 @@ class ClusteringRecommender:
         log.info(f"Clustering returned {len(recommendations)} recommendations")
         return recommendations
     
+    def _db_to_responses(self, assessments: List[dict]) -> List[AssessmentResponse]:
+        """Convert database rows to response schemas in one pass"""
+        return [self._db_to_response(a) for a in assessments]
+    
     def _db_to_response(self, assessment: dict) -> AssessmentResponse:
         """Convert database model to response schema"""
-        return AssessmentResponse(
+        # Fields are normalized here, so skip pydantic validation
+        test_types = assessment.get('test_types')
+        industries = assessment.get('industries')
+        languages = assessment.get('languages', ['English'])
+        skills = assessment.get('skills')
+        return AssessmentResponse.model_construct(
             id=assessment.get('id', ''),
             name=assessment.get('name', 'Unknown Assessment'),
             type=assessment.get('type', 'Assessment'),
-            test_types=assessment.get('test_types', []) if isinstance(assessment.get('test_types'), list) else [],
+            test_types=test_types if isinstance(test_types, list) else [],
             remote_testing=assessment.get('remote_testing', False),
             adaptive=assessment.get('adaptive', False),
             job_family=assessment.get('job_family') or None,
             job_level=assessment.get('job_level') or None,
-            industries=assessment.get('industries', []) if isinstance(assessment.get('industries'), list) else [],
-            languages=assessment.get('languages', ['English']) if isinstance(assessment.get('languages'), list) else [],
-            skills=assessment.get('skills', []) if isinstance(assessment.get('skills'), list) else [],
+            industries=industries if isinstance(industries, list) else [],
+            languages=languages if isinstance(languages, list) else [],
+            skills=skills if isinstance(skills, list) else [],
             description=assessment.get('description', ''),
             duration=assessment.get('duration') or None
         )
-
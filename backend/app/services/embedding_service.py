@@ -3,17 +3,47 @@ HuggingFace Embedding Service
 Provides embeddings using HuggingFace Inference API instead of local models
 This reduces memory usage significantly for deployment on Render
 """
+import hashlib
 import os
+import threading
 import time
-from typing import List, Union
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Union
+from cachetools import LRUCache
 from huggingface_hub import InferenceClient
 import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from app.core.config import get_settings
 from app.core.logging import log
 
 settings = get_settings()
 
+# Shared HTTP session for the custom Space: pools connections and reuses TLS
+# sessions across encode calls. Retries are handled by _encode_via_space.
+_session = requests.Session()
+_session.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=Retry(total=0)))
+_session.mount('http://', HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=Retry(total=0)))
+_session.headers.update({'Accept-Encoding': 'gzip'})
+
+# Batches of one encode call are sent concurrently (bounded to typical HF rate limits)
+_MAX_CONCURRENT_BATCHES = 8
+_batch_pool = ThreadPoolExecutor(max_workers=_MAX_CONCURRENT_BATCHES, thread_name_prefix="hf-embed")
+
+
+# Query embeddings by content hash - repeat queries skip the HF round trip
+_query_cache: LRUCache = LRUCache(maxsize=1024)
+_query_cache_lock = threading.Lock()
+
+
+def _map_batches(fn: Callable[[List[str]], list], batches: List[List[str]]) -> List[list]:
+    """Apply fn to every batch, up to _MAX_CONCURRENT_BATCHES in flight; results keep batch order"""
+    if len(batches) <= 1:
+        return [fn(batch) for batch in batches]
+    return list(_batch_pool.map(fn, batches))
+
 
 class HuggingFaceEmbeddingService:
     """
@@ -87,12 +117,83 @@ class HuggingFaceEmbeddingService:
         if is_single:
             texts = [texts]
         
+        # Only send each distinct text once; results are scattered back below
+        unique_texts = list(dict.fromkeys(texts))
+        
+        if is_query:
+            embeddings = self._encode_queries_cached(unique_texts, normalize_embeddings, batch_size, max_retries)
+        else:
+            embeddings = self._encode_backend(unique_texts, normalize_embeddings, batch_size, max_retries, is_query)
+        
+        if len(unique_texts) == len(texts):
+            return embeddings
+        
+        position = {text: i for i, text in enumerate(unique_texts)}
+        inverse = np.fromiter((position[text] for text in texts), dtype=np.intp, count=len(texts))
+        return embeddings[inverse]
+    
+    def _encode_backend(
+        self, 
+        texts: List[str], 
+        normalize: bool,
+        batch_size: int,
+        max_retries: int,
+        is_query: bool
+    ) -> np.ndarray:
+        """Encode through whichever backend is configured"""
+        if len(texts) <= batch_size:
+            return self._encode_sorted(texts, normalize, batch_size, max_retries, is_query)
+        
+        # Group similar lengths into the same request so each server-side batch is
+        # padded to a near-uniform length; rows are restored to input order below
+        order = np.argsort(np.fromiter((len(text) for text in texts), dtype=np.intp, count=len(texts)), kind='stable')
+        sorted_embeddings = self._encode_sorted([texts[i] for i in order], normalize, batch_size, max_retries, is_query)
+        embeddings = np.empty_like(sorted_embeddings)
+        embeddings[order] = sorted_embeddings
+        return embeddings
+    
+    def _encode_sorted(
+        self, 
+        texts: List[str], 
+        normalize: bool,
+        batch_size: int,
+        max_retries: int,
+        is_query: bool
+    ) -> np.ndarray:
+        """Encode texts in the given order through the configured backend"""
         # Use custom Space if configured
         if self.use_space and self.space_url:
-            return self._encode_via_space(texts, normalize_embeddings, batch_size, max_retries, is_query)
-        
+            return self._encode_via_space(texts, normalize, batch_size, max_retries, is_query)
         # Otherwise use HuggingFace Inference API
-        return self._encode_via_inference_api(texts, normalize_embeddings, batch_size, max_retries, is_query)
+        return self._encode_via_inference_api(texts, normalize, batch_size, max_retries, is_query)
+    
+    def _encode_queries_cached(
+        self, 
+        texts: List[str], 
+        normalize: bool,
+        batch_size: int,
+        max_retries: int
+    ) -> np.ndarray:
+        """Encode queries, serving repeats from the LRU and only sending the misses"""
+        backend = self.space_url if self.use_space and self.space_url else self.model_name
+        keys = [
+            hashlib.blake2b(f"{backend}\x00{normalize}\x00{text}".encode("utf-8"), digest_size=16).digest()
+            for text in texts
+        ]
+        with _query_cache_lock:
+            embeddings = [_query_cache.get(key) for key in keys]
+        
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            fresh = self._encode_backend([texts[i] for i in missing], normalize, batch_size, max_retries, True)
+            with _query_cache_lock:
+                for i, embedding in zip(missing, fresh):
+                    embeddings[i] = _query_cache[keys[i]] = embedding.copy()
+        
+        if not embeddings:
+            return np.zeros((0, self.dimension), dtype=np.float32)
+        # Stacking copies, so callers never mutate cached vectors
+        return np.stack(embeddings)
     
     def _encode_via_inference_api(
         self, 
@@ -103,84 +204,24 @@ class HuggingFaceEmbeddingService:
         is_query: bool = False
     ) -> np.ndarray:
         """Encode using HuggingFace Inference API with improved timeout handling"""
-        all_embeddings = []
-        
-        # Process in batches to handle rate limits
-        for i in range(0, len(texts), batch_size):
-            batch = texts[i:i + batch_size]
-            
-            for attempt in range(max_retries):
-                try:
-                    # Call feature extraction API with longer timeout
-                    if len(batch) == 1:
-                        # Single text
-                        embedding = self.client.feature_extraction(
-                            text=batch[0],
-                            model=self.model_name,
-                            timeout=60.0  # Increased timeout to 60 seconds
-                        )
-                        # Handle different response formats
-                        if isinstance(embedding, list) and len(embedding) > 0:
-                            if isinstance(embedding[0], list):
-                                # Already in correct format
-                                batch_embeddings = embedding
-                            else:
-                                # Single embedding
-                                batch_embeddings = [embedding]
-                        else:
-                            batch_embeddings = [embedding]
-                    else:
-                        # Multiple texts - process individually due to API limitations
-                        batch_embeddings = []
-                        for text in batch:
-                            emb = self.client.feature_extraction(
-                                text=text,
-                                model=self.model_name,
-                                timeout=60.0  # Increased timeout
-                            )
-                            # Ensure it's a list
-                            if isinstance(emb, list) and len(emb) > 0 and isinstance(emb[0], list):
-                                batch_embeddings.append(emb[0])
-                            else:
-                                batch_embeddings.append(emb)
-                    
-                    all_embeddings.extend(batch_embeddings)
-                    break  # Success, exit retry loop
-                    
-                except Exception as e:
-                    error_msg = str(e).lower()
-                    
-                    # Handle different error types
-                    if "timeout" in error_msg or "504" in error_msg:
-                        if attempt < max_retries - 1:
-                            # Timeout error - wait longer before retry
-                            wait_time = (attempt + 1) * 5  # 5s, 10s, 15s
-                            log.warning(f"Timeout on attempt {attempt + 1}/{max_retries}, waiting {wait_time}s before retry")
-                            time.sleep(wait_time)
-                        else:
-                            log.error(f"Failed after {max_retries} timeout attempts: {e}")
-                            raise
-                    elif "rate limit" in error_msg:
-                        if attempt < max_retries - 1:
-                            # Rate limited, wait and retry
-                            wait_time = (attempt + 1) * 3  # 3s, 6s, 9s
-                            log.warning(f"Rate limited, waiting {wait_time}s before retry {attempt + 1}/{max_retries}")
-                            time.sleep(wait_time)
-                        else:
-                            log.error(f"Rate limit exceeded after {max_retries} attempts")
-                            raise
-                    else:
-                        # Other error - log and raise
-                        log.error(f"Error generating embeddings: {e}")
-                        raise
+        # Process in batches to handle rate limits, several in flight at once
+        batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+        all_embeddings = [
+            embedding
+            for batch_embeddings in _map_batches(lambda batch: self._inference_api_batch(batch, max_retries), batches)
+            for embedding in batch_embeddings
+        ]
         
         # Convert to numpy array
         embeddings_array = np.array(all_embeddings, dtype=np.float32)
         
         # Normalize if requested
-        if normalize:
-            norms = np.linalg.norm(embeddings_array, axis=1, keepdims=True)
-            embeddings_array = embeddings_array / np.maximum(norms, 1e-12)
+        if normalize and embeddings_array.size:
+            # Row norms via einsum, then divide in place (no temporaries)
+            norms = np.einsum('ij,ij->i', embeddings_array, embeddings_array)
+            np.sqrt(norms, out=norms)
+            np.maximum(norms, 1e-12, out=norms)
+            embeddings_array /= norms[:, None]
         
         return embeddings_array
     
@@ -193,38 +234,106 @@ class HuggingFaceEmbeddingService:
         is_query: bool = False
     ) -> np.ndarray:
         """Encode using custom HuggingFace Space"""
-        import requests
-        
-        all_embeddings = []
+        # Process in batches, several in flight at once
+        batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+        all_embeddings = [
+            embedding
+            for batch_embeddings in _map_batches(
+                lambda batch: self._space_batch(batch, normalize, max_retries, is_query), batches
+            )
+            for embedding in batch_embeddings
+        ]
         
-        # Process in batches
-        for i in range(0, len(texts), batch_size):
-            batch = texts[i:i + batch_size]
-            
-            for attempt in range(max_retries):
-                try:
-                    response = requests.post(
-                        f"{self.space_url}/embed",
-                        json={"texts": batch, "normalize": normalize, "is_query": is_query},
-                        timeout=30
+        return np.array(all_embeddings, dtype=np.float32)
+    
+    def _inference_api_batch(self, batch: List[str], max_retries: int) -> list:
+        """Embed one batch through the Inference API, retrying timeouts and rate limits"""
+        for attempt in range(max_retries):
+            try:
+                # Call feature extraction API with longer timeout
+                if len(batch) == 1:
+                    # Single text
+                    embedding = self.client.feature_extraction(
+                        text=batch[0],
+                        model=self.model_name,
+                        timeout=60.0  # Increased timeout to 60 seconds
                     )
-                    response.raise_for_status()
-                    
-                    data = response.json()
-                    batch_embeddings = data.get("embeddings", [])
-                    all_embeddings.extend(batch_embeddings)
-                    break  # Success
-                    
-                except Exception as e:
+                    # Handle different response formats
+                    if isinstance(embedding, list) and len(embedding) > 0:
+                        if isinstance(embedding[0], list):
+                            # Already in correct format
+                            batch_embeddings = embedding
+                        else:
+                            # Single embedding
+                            batch_embeddings = [embedding]
+                    else:
+                        batch_embeddings = [embedding]
+                else:
+                    # Multiple texts - process individually due to API limitations
+                    batch_embeddings = []
+                    for text in batch:
+                        emb = self.client.feature_extraction(
+                            text=text,
+                            model=self.model_name,
+                            timeout=60.0  # Increased timeout
+                        )
+                        # Ensure it's a list
+                        if isinstance(emb, list) and len(emb) > 0 and isinstance(emb[0], list):
+                            batch_embeddings.append(emb[0])
+                        else:
+                            batch_embeddings.append(emb)
+                
+                return batch_embeddings
+                
+            except Exception as e:
+                error_msg = str(e).lower()
+                
+                # Handle different error types
+                if "timeout" in error_msg or "504" in error_msg:
                     if attempt < max_retries - 1:
-                        wait_time = (attempt + 1) * 2
-                        log.warning(f"Space request failed, retrying in {wait_time}s: {e}")
+                        # Timeout error - wait longer before retry
+                        wait_time = (attempt + 1) * 5  # 5s, 10s, 15s
+                        log.warning(f"Timeout on attempt {attempt + 1}/{max_retries}, waiting {wait_time}s before retry")
                         time.sleep(wait_time)
                     else:
-                        log.error(f"Failed to get embeddings from Space: {e}")
+                        log.error(f"Failed after {max_retries} timeout attempts: {e}")
                         raise
-        
-        return np.array(all_embeddings, dtype=np.float32)
+                elif "rate limit" in error_msg:
+                    if attempt < max_retries - 1:
+                        # Rate limited, wait and retry
+                        wait_time = (attempt + 1) * 3  # 3s, 6s, 9s
+                        log.warning(f"Rate limited, waiting {wait_time}s before retry {attempt + 1}/{max_retries}")
+                        time.sleep(wait_time)
+                    else:
+                        log.error(f"Rate limit exceeded after {max_retries} attempts")
+                        raise
+                else:
+                    # Other error - log and raise
+                    log.error(f"Error generating embeddings: {e}")
+                    raise
+    
+    def _space_batch(self, batch: List[str], normalize: bool, max_retries: int, is_query: bool) -> list:
+        """Embed one batch through the custom Space, retrying with backoff"""
+        for attempt in range(max_retries):
+            try:
+                response = _session.post(
+                    f"{self.space_url}/embed",
+                    json={"texts": batch, "normalize": normalize, "is_query": is_query},
+                    timeout=30
+                )
+                response.raise_for_status()
+                
+                data = response.json()
+                return data.get("embeddings", [])
+                
+            except Exception as e:
+                if attempt < max_retries - 1:
+                    wait_time = (attempt + 1) * 2
+                    log.warning(f"Space request failed, retrying in {wait_time}s: {e}")
+                    time.sleep(wait_time)
+                else:
+                    log.error(f"Failed to get embeddings from Space: {e}")
+                    raise
     
     def get_dimension(self) -> int:
         """Get embedding dimension"""
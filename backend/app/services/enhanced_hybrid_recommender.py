@@ -1,6 +1,6 @@
 from typing import List, Dict, Any, Optional
 import logging
-from app.services.rag_recommender_v2 import RAGRecommender
+from app.services.rag_recommender_v2 import get_rag_recommender
 
 log = logging.getLogger(__name__)
 
@@ -10,9 +10,13 @@ class EnhancedHybridRecommender:
     Currently prioritizes RAG (Retrieval-Augmented Generation) for PDF compliance.
     """
     def __init__(self):
-        self.rag_recommender = RAGRecommender()
+        self.rag_recommender = get_rag_recommender()
         log.info("Initialized EnhancedHybridRecommender with RAG engine.")
 
+    def warmup(self):
+        """Build lazily-loaded indexes before serving the first request"""
+        self.rag_recommender.warmup()
+
     def recommend(self, query: str, n_results: int = 10) -> Dict[str, Any]:
         """
         Get recommendations for a user query.
@@ -1,9 +1,21 @@
 """
 Gemini AI-based recommendation engine
 """
-from typing import List, Dict, Optional
-import json
-import google.generativeai as genai
+from typing import Callable, List, Dict, Optional, Tuple
+from dataclasses import dataclass, field
+from datetime import timedelta
+from functools import partial
+import asyncio
+import hashlib
+import io
+import os
+import time
+import ijson
+import orjson
+from rapidfuzz import fuzz, process
+from google import genai
+from google.genai import types
+from cachetools import TTLCache
 
 from app.models.schemas import RecommendationRequest, RecommendationItem, RecommendationScore, AssessmentResponse
 from app.core.config import get_settings
@@ -11,6 +23,57 @@ from app.core.logging import log
 
 settings = get_settings()
 
+# Parsed Gemini recommendation lists (plain dicts), keyed by request + catalog
+_recommendation_cache: TTLCache = TTLCache(maxsize=512, ttl=3600)
+
+# Reflection-heavy (dir() of SDK objects) dump of empty responses; opt-in only
+GEMINI_DEEP_DEBUG = os.getenv("GEMINI_DEEP_DEBUG", "false").lower() == "true"
+
+# Lifetime of the server-side cached catalog context
+CATALOG_CONTEXT_TTL = timedelta(hours=1)
+
+CATALOG_SYSTEM_INSTRUCTION = (
+    "You recommend SHL assessments. The assessment catalog is provided as JSON "
+    "in the cached context; only recommend ids that appear in it."
+)
+
+
+# (raw index, raw item) -> filtered catalog item, or None when it is skipped
+_Resolver = Callable[[int, dict], Optional[RecommendationItem]]
+
+
+@dataclass
+class _PendingQuery:
+    """A recommend call waiting to be coalesced into a Gemini batch"""
+    request: RecommendationRequest
+    catalog: str
+    catalog_sig: str
+    resolve: _Resolver
+    future: asyncio.Future
+
+
+@dataclass
+class _ParsedItems:
+    """Items parsed from one Gemini response"""
+    items: List[dict]
+    # False when the response was cut short (truncation, stream or parse error)
+    # before enough items were resolved
+    complete: bool
+    resolved: List[RecommendationItem] = field(default_factory=list)
+    
+    def collect(self, items: List[dict], resolve: Optional[_Resolver], max_results: Optional[int]) -> bool:
+        """Append raw items, resolving each as it arrives; True once max_results have resolved"""
+        for item in items:
+            self.items.append(item)
+            if resolve is None:
+                continue
+            resolved = resolve(len(self.items) - 1, item)
+            if resolved is not None:
+                self.resolved.append(resolved)
+                if max_results is not None and len(self.resolved) >= max_results:
+                    return True
+        return False
+
 
 class GeminiRecommender:
     """
@@ -20,19 +83,39 @@ class GeminiRecommender:
     def __init__(self):
         """Initialize Gemini recommender"""
         if settings.gemini_api_key:
-            genai.configure(api_key=settings.gemini_api_key)
-            model_name = settings.gemini_model if hasattr(settings, 'gemini_model') else 'gemini-pro'
-            self.model = genai.GenerativeModel(
-                model_name=model_name,
-                generation_config={
-                    "temperature": settings.gemini_temperature if hasattr(settings, 'gemini_temperature') else 0.7,
-                    "max_output_tokens": 4096,  # Increased to prevent truncation
-                }
-            )
+            self.client = genai.Client(api_key=settings.gemini_api_key)
+            self.model_name = settings.gemini_model if hasattr(settings, 'gemini_model') else 'gemini-pro'
+            self.generation_config = {
+                "temperature": settings.gemini_temperature if hasattr(settings, 'gemini_temperature') else 0.7,
+                "max_output_tokens": 4096,  # Upper bound; per-call budget scales with num_recommendations
+            }
             log.info("Gemini recommender initialized")
         else:
             log.warning("Gemini API key not configured")
-            self.model = None
+            self.client = None
+        
+        # Server-side cached catalog context (refreshed when the catalog changes)
+        self._catalog_context_name: Optional[str] = None
+        self._catalog_context_sig = None
+        self._catalog_context_expires = 0.0
+        self._catalog_context_lock = asyncio.Lock()
+        
+        # (signature, assessment_map, fuzzy_map, responses) for the last seen
+        # assessments table, reused while the table is unchanged
+        self._catalog_snapshot: Optional[Tuple[int, Dict[str, dict], Dict[str, dict], Dict[str, AssessmentResponse]]] = None
+        
+        # Micro-batching of concurrent requests (queue/worker created lazily
+        # per running event loop)
+        self.batch_size = settings.gemini_batch_size
+        self.batch_max_wait = settings.gemini_batch_max_wait_ms / 1000
+        self._batch_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._batch_queue: Optional[asyncio.Queue] = None
+        self._batch_worker_task: Optional[asyncio.Task] = None
+        self._batch_tasks: set = set()  # Strong refs to in-flight batch calls
+        
+        # Hedged requests: duplicate a call still running after hedge_after seconds
+        self.hedge_enabled = settings.gemini_hedge_enabled
+        self.hedge_after = settings.gemini_hedge_after_ms / 1000
     
     def _create_assessment_catalog(self, assessments: List[dict]) -> str:
         """Create formatted assessment catalog"""
@@ -45,20 +128,85 @@ class GeminiRecommender:
                 "type": assessment.get('type', ''),
                 "job_family": assessment.get('job_family', ''),
                 "job_level": assessment.get('job_level', ''),
-                "test_types": [],
-                "skills": [][:5],  # Limit for token efficiency
-                "industries": [],
                 "duration": assessment.get('duration', 0),
                 "remote_testing": assessment.get('remote_testing', False),
                 "description": (assessment.get('description', '')[:150] + "...") if assessment.get('description', '') and len(assessment.get('description', '')) > 150 else assessment.get('description', '')
             }
-            catalog.append(entry)
+            # Drop empty fields - every key costs prompt tokens
+            catalog.append({k: v for k, v in entry.items() if v not in ('', None)})
         
-        return json.dumps(catalog, indent=2)
+        # orjson output is compact (no indentation/spaces) - token efficiency
+        return orjson.dumps(catalog).decode("utf-8")
+    
+    def _cache_key(self, request: RecommendationRequest, catalog_sig: str) -> str:
+        """Stable key for the prompt-relevant request fields plus the catalog"""
+        payload = {
+            "job_title": (request.job_title or "").strip().lower(),
+            "job_level": request.job_level or "",
+            "industry": (request.industry or "").strip().lower(),
+            "required_skills": [s.strip().lower() for s in (request.required_skills or [])[:8]],
+            "num_recommendations": request.num_recommendations,
+            # Cached lists stop at the last item the filters needed
+            "remote_testing_required": bool(request.remote_testing_required),
+            "max_duration": request.max_duration or 0,
+            "language": request.language or "",
+            "catalog_sig": catalog_sig,
+        }
+        return hashlib.blake2b(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)).hexdigest()
     
-    def _create_prompt(self, request: RecommendationRequest, catalog: str) -> str:
-        """Create prompt for Gemini"""
+    async def _get_catalog_context(self, catalog: str, catalog_sig: str) -> Optional[str]:
+        """
+        Name of a server-side cached copy of the catalog, so only the
+        per-request block is sent with each call.
+        
+        Returns None when context caching is unavailable (e.g. the catalog is
+        below the model's minimum cacheable size); callers then inline it.
+        """
+        if self._catalog_context_fresh(catalog_sig):
+            return self._catalog_context_name
+        
+        # One creation at a time: concurrent cold-start requests would each
+        # create (and pay for) their own copy otherwise
+        async with self._catalog_context_lock:
+            if self._catalog_context_fresh(catalog_sig):
+                return self._catalog_context_name
+            
+            # Catalog changed or context expired. The old context is not deleted:
+            # in-flight calls may still reference it and its own TTL cleans it up
+            now = time.monotonic()
+            try:
+                cached = await self.client.aio.caches.create(
+                    model=self.model_name,
+                    config=types.CreateCachedContentConfig(
+                        display_name="shl-assessment-catalog",
+                        system_instruction=CATALOG_SYSTEM_INSTRUCTION,
+                        contents=[f"Assessments:\n{catalog}"],
+                        ttl=f"{int(CATALOG_CONTEXT_TTL.total_seconds())}s"
+                    )
+                )
+                name = cached.name
+                # Refresh a minute early so we never reference an expired context
+                expires = now + CATALOG_CONTEXT_TTL.total_seconds() - 60
+                log.info("Gemini catalog context cached server-side")
+            except Exception as e:
+                log.warning(f"Gemini context caching unavailable, sending catalog inline: {e}")
+                # Don't retry creation until the catalog changes or the TTL lapses
+                name = None
+                expires = now + CATALOG_CONTEXT_TTL.total_seconds()
+            
+            self._catalog_context_name = name
+            self._catalog_context_sig = catalog_sig
+            self._catalog_context_expires = expires
+            return name
+    
+    def _catalog_context_fresh(self, catalog_sig: str) -> bool:
+        """Whether the current catalog context (or its recorded absence) is still valid for catalog_sig"""
+        return self._catalog_context_sig == catalog_sig and time.monotonic() < self._catalog_context_expires
+    
+    def _create_prompt(self, request: RecommendationRequest, catalog: Optional[str]) -> str:
+        """Create prompt for Gemini (catalog=None when it is in cached context)"""
         skills_str = ', '.join(request.required_skills[:8]) if request.required_skills else 'Any'
+        catalog_block = f"Assessments:\n{catalog}" if catalog is not None else "Assessments: use the catalog provided in context."
         
         prompt = f"""Select the top {request.num_recommendations} most relevant assessments for:
 Job: {request.job_title or 'Any'}
@@ -66,13 +214,37 @@ Level: {request.job_level or 'Any'}
 Skills: {skills_str}
 Industry: {request.industry or 'Any'}
 
-Assessments:
-{catalog}
+{catalog_block}
 
 IMPORTANT: Return ONLY a valid JSON object. Keep explanations brief (max 20 words).
 Format: {{"recommendations": [{{"id": "assessment_id", "relevance_score": 0.9, "skill_match_score": 0.85, "explanation": "Brief reason"}}]}}"""
         return prompt
     
+    def _create_batch_prompt(self, queries: List[_PendingQuery], catalog: Optional[str]) -> str:
+        """Create one prompt answering several requests that share a catalog"""
+        query_specs = [
+            {
+                "query_id": f"q{i}",
+                "top_k": q.request.num_recommendations,
+                "job": q.request.job_title or 'Any',
+                "level": q.request.job_level or 'Any',
+                "skills": ', '.join(q.request.required_skills[:8]) if q.request.required_skills else 'Any',
+                "industry": q.request.industry or 'Any'
+            }
+            for i, q in enumerate(queries)
+        ]
+        catalog_block = f"Assessments:\n{catalog}" if catalog is not None else "Assessments: use the catalog provided in context."
+        
+        prompt = f"""For each query below, select its top_k most relevant assessments.
+Queries:
+{orjson.dumps(query_specs).decode("utf-8")}
+
+{catalog_block}
+
+IMPORTANT: Return ONLY a valid JSON object with one entry per query_id. Keep explanations brief (max 20 words).
+Format: {{"results": [{{"query_id": "q0", "recommendations": [{{"id": "assessment_id", "relevance_score": 0.9, "skill_match_score": 0.85, "explanation": "Brief reason"}}]}}]}}"""
+        return prompt
+    
     async def recommend(
         self, 
         request: RecommendationRequest, 
@@ -81,10 +253,10 @@ Format: {{"recommendations": [{{"id": "assessment_id", "relevance_score": 0.9, "
         """
         Generate recommendations using Gemini AI
         """
-        log.info(f"Gemini recommendation for: {request.dict()}")
+        log.opt(lazy=True).debug("Gemini recommendation for: {}", lambda: request.model_dump())
         
-        if not self.model:
-            log.warning("Gemini model not initialized - skipping")
+        if not self.client:
+            log.warning("Gemini client not initialized - skipping")
             return []
         
         # Get all assessments
@@ -103,174 +275,491 @@ Format: {{"recommendations": [{{"id": "assessment_id", "relevance_score": 0.9, "
         # Use 25 assessments to avoid token limit issues
         catalog = self._create_assessment_catalog(assessments[:25])
         
-        # Create prompt
-        prompt = self._create_prompt(request, catalog)
-        log.debug(f"Prompt length: {len(prompt)} chars")
+        catalog_sig = hashlib.sha256(catalog.encode("utf-8")).hexdigest()
+        cache_key = self._cache_key(request, catalog_sig)
+        raw_recommendations = _recommendation_cache.get(cache_key)
         
         try:
-            # Generate response
-            response = self.model.generate_content(prompt)
-            
-            # Log response structure for debugging
-            log.debug(f"Gemini response type: {type(response)}")
+            # Items are matched against the catalog and filtered as they are
+            # parsed, so a streamed answer can stop once it has enough
+            resolve = partial(self._resolve_recommendation, request, *self._get_catalog_snapshot(assessments))
             
-            # Check if response was blocked
-            if not response.candidates:
-                log.error("Gemini response was blocked (safety filters or empty)")
-                if hasattr(response, 'prompt_feedback'):
-                    feedback = response.prompt_feedback
-                    log.error(f"Prompt feedback: block_reason={getattr(feedback, 'block_reason', 'unknown')}, safety_ratings={getattr(feedback, 'safety_ratings', [])}")
+            if raw_recommendations is None:
+                if self.batch_size > 1:
+                    parsed = await self._submit_to_batch(request, catalog, catalog_sig, resolve)
                 else:
-                    log.debug(f"No prompt feedback available")
-                return []
+                    parsed = await self._recommend_single(request, catalog, catalog_sig, resolve)
+                if parsed is None:
+                    return []
+                # Partial (truncated) or empty answers are served but never pinned
+                if parsed.complete and parsed.items:
+                    _recommendation_cache[cache_key] = parsed.items
+            else:
+                log.info("Gemini cache hit - skipping generate_content")
+                parsed = _ParsedItems([], complete=True)
+                parsed.collect(raw_recommendations, resolve, request.num_recommendations)
             
-            # Log candidate info for debugging
-            for i, candidate in enumerate(response.candidates):
-                log.debug(f"Candidate {i}: finish_reason={getattr(candidate, 'finish_reason', 'N/A')}")
-                if hasattr(candidate, 'content') and candidate.content:
-                    log.debug(f"Candidate {i} has content with {len(candidate.content.parts) if hasattr(candidate.content, 'parts') else 0} parts")
+            if not parsed.items:
+                log.warning("No recommendations in Gemini response")
+                return []
             
-            # Extract text from response (handle multi-part responses including "thinking" models)
-            response_text = ""
+            recommendations = parsed.resolved
+            log.info(f"Gemini returned {len(recommendations)} recommendations")
+            return recommendations
             
-            # First try the direct .text accessor
-            try:
-                response_text = response.text
-                log.debug(f"Got response using .text accessor, length: {len(response_text)}")
-            except ValueError as ve:
-                # This happens with models that have "thinking" parts (like gemini-2.5-pro)
-                log.debug(f"ValueError with .text accessor: {ve}")
-                # Extract text parts manually, skipping "thinking" parts
-                try:
-                    for candidate in response.candidates:
-                        if hasattr(candidate, 'content') and candidate.content:
-                            for part in candidate.content.parts:
-                                # Check if this is a text part (not a thinking/tool part)
-                                if hasattr(part, 'text') and part.text:
-                                    response_text += part.text
-                                    log.debug(f"Extracted text part: {part.text[:100] if len(part.text) > 100 else part.text}...")
-                except Exception as ex:
-                    log.error(f"Failed to extract text from parts: {ex}")
-            except Exception as e:
-                # For other exceptions, try the parts accessor
-                log.debug(f"Exception with .text accessor: {type(e).__name__}: {e}")
+        except Exception as e:
+            log.error(f"Gemini recommendation error: {e}")
+            return []
+    
+    def _resolve_recommendation(
+        self,
+        request: RecommendationRequest,
+        assessment_map: Dict[str, dict],
+        fuzzy_map: Dict[str, dict],
+        responses: Dict[str, AssessmentResponse],
+        idx: int,
+        rec: dict
+    ) -> Optional[RecommendationItem]:
+        """Match one raw Gemini item to the catalog and apply the request filters"""
+        assessment_id = rec.get("id")
+        
+        # Try exact match first
+        assessment = assessment_map.get(assessment_id)
+        
+        # If not found, try fuzzy matching (case-insensitive, handle special chars)
+        if not assessment and assessment_id:
+            normalized_id = self._normalize_key(assessment_id)
+            assessment = fuzzy_map.get(normalized_id)
+            if not assessment:
+                # partial_ratio scores 100 on substring containment, like the old scan
+                match = process.extractOne(normalized_id, fuzzy_map.keys(), scorer=fuzz.partial_ratio, score_cutoff=85)
+                if match:
+                    assessment = fuzzy_map[match[0]]
+            if assessment:
+                log.info(f"Fuzzy matched '{assessment_id}' to '{assessment.get('id')}'")
+        
+        if not assessment:
+            log.warning(f"Assessment {assessment_id} not found (skipping)")
+            return None
+        
+        # Apply filters
+        if request.remote_testing_required and not assessment.get('remote_testing', False):
+            return None
+        
+        if request.max_duration and assessment.get('duration', 0) and assessment.get('duration', 0) > request.max_duration:
+            return None
+        
+        if request.language:
+            languages = ['English']
+            if request.language not in languages:
+                return None
+        
+        assessment_response = responses.get(assessment.get('id')) or self._db_to_response(assessment)
+        
+        score = RecommendationScore(
+            total_score=rec.get("relevance_score", 0.8),
+            relevance_score=rec.get("relevance_score", 0.8),
+            skill_match_score=rec.get("skill_match_score"),
+            confidence=rec.get("relevance_score", 0.8),
+            explanation=rec.get("explanation", "AI-recommended")
+        )
+        
+        return RecommendationItem(
+            assessment=assessment_response,
+            score=score,
+            rank=idx + 1
+        )
+    
+    async def _recommend_single(
+        self,
+        request: RecommendationRequest,
+        catalog: str,
+        catalog_sig: str,
+        resolve: Optional[_Resolver] = None
+    ) -> Optional[_ParsedItems]:
+        """Run one request as its own Gemini call"""
+        # Prefer the server-side cached catalog; fall back to inlining it
+        catalog_context = await self._get_catalog_context(catalog, catalog_sig)
+        if catalog_context is not None:
+            prompt = self._create_prompt(request, None)
+        else:
+            prompt = self._create_prompt(request, catalog)
+        log.debug(f"Prompt length: {len(prompt)} chars")
+        
+        budget = self._output_token_budget(request.num_recommendations)
+        return await self._hedged_generate(
+            prompt, "recommendations.item", catalog_context, max_output_tokens=budget,
+            resolve=resolve, max_results=request.num_recommendations
+        )
+    
+    async def _submit_to_batch(
+        self,
+        request: RecommendationRequest,
+        catalog: str,
+        catalog_sig: str,
+        resolve: _Resolver
+    ) -> Optional[_ParsedItems]:
+        """Queue a request for the batch worker and wait for its share of the result"""
+        loop = asyncio.get_running_loop()
+        if self._batch_loop is not loop:
+            # Queues and tasks belong to one loop; start fresh on a new one
+            self._batch_loop = loop
+            self._batch_queue = asyncio.Queue()
+            self._batch_tasks = set()
+            self._batch_worker_task = loop.create_task(self._batch_worker(self._batch_queue))
+        
+        future = loop.create_future()
+        await self._batch_queue.put(_PendingQuery(request, catalog, catalog_sig, resolve, future))
+        return await future
+    
+    async def _batch_worker(self, queue: asyncio.Queue):
+        """Drain up to batch_size queued requests (or wait batch_max_wait) per call"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            # A lone request with no call in flight is sent straight away; the
+            # batch window only applies while there is concurrent traffic
+            if queue.empty() and not self._batch_tasks:
+                deadline = loop.time()
+            else:
+                deadline = loop.time() + self.batch_max_wait
+            while len(batch) < self.batch_size:
+                if not queue.empty():
+                    batch.append(queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
                 try:
-                    for candidate in response.candidates:
-                        if hasattr(candidate, 'content') and candidate.content:
-                            for part in candidate.content.parts:
-                                if hasattr(part, 'text') and part.text:
-                                    response_text += part.text
-                                    log.debug(f"Extracted text from part: {part.text[:100] if len(part.text) > 100 else part.text}...")
-                except Exception as ex:
-                    log.error(f"Failed to extract text from parts: {ex}")
-                    log.error(f"Response object: {response}")
-                    log.error(f"Candidates: {response.candidates if hasattr(response, 'candidates') else 'N/A'}")
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
             
-            if not response_text or len(response_text.strip()) == 0:
-                log.error("Empty response from Gemini after text extraction")
-                log.debug(f"Response candidates: {response.candidates if hasattr(response, 'candidates') else 'No candidates'}")
-                # Log the full response structure for debugging
+            # Only requests that see the same catalog can share a prompt
+            groups: Dict[str, List[_PendingQuery]] = {}
+            for pending in batch:
+                groups.setdefault(pending.catalog_sig, []).append(pending)
+            for group in groups.values():
+                task = asyncio.create_task(self._run_batch(group))
+                self._batch_tasks.add(task)
+                task.add_done_callback(self._batch_tasks.discard)
+    
+    async def _run_batch(self, group: List[_PendingQuery]):
+        """Answer a group of queued requests and resolve their futures"""
+        try:
+            if len(group) == 1:
+                pending = group[0]
+                results = [await self._recommend_single(pending.request, pending.catalog, pending.catalog_sig, pending.resolve)]
+            else:
+                catalog, catalog_sig = group[0].catalog, group[0].catalog_sig
+                catalog_context = await self._get_catalog_context(catalog, catalog_sig)
+                prompt = self._create_batch_prompt(group, None if catalog_context is not None else catalog)
+                log.info(f"Gemini batching {len(group)} requests into one call")
+                
+                # Room for every query's answer in a single response
+                budget = min(8192, sum(self._output_token_budget(q.request.num_recommendations) for q in group))
+                entries = await self._hedged_generate(prompt, "results.item", catalog_context, max_output_tokens=budget)
+                # Each parsed entry is a whole query answer even if the response
+                # was truncated later; queries without an entry get None
+                by_query = {}
+                if entries is not None:
+                    for entry in entries.items:
+                        by_query[entry.get("query_id")] = entry.get("recommendations") or []
+                results = []
+                for i, pending in enumerate(group):
+                    recs = by_query.get(f"q{i}")
+                    parsed = None
+                    if recs is not None:
+                        parsed = _ParsedItems([], complete=True)
+                        parsed.collect(recs, pending.resolve, pending.request.num_recommendations)
+                    results.append(parsed)
+            
+            for pending, recs in zip(group, results):
+                if not pending.future.done():
+                    pending.future.set_result(recs)
+        except Exception as e:
+            for pending in group:
+                if not pending.future.done():
+                    pending.future.set_exception(e)
+    
+    def _output_token_budget(self, num_recommendations: int) -> int:
+        """~120 tokens per recommendation plus JSON overhead, capped at the configured max"""
+        return min(self.generation_config["max_output_tokens"], 120 * num_recommendations + 256)
+    
+    async def _hedged_generate(
+        self,
+        prompt: str,
+        items_path: str,
+        catalog_context: Optional[str] = None,
+        max_output_tokens: Optional[int] = None,
+        resolve: Optional[_Resolver] = None,
+        max_results: Optional[int] = None
+    ) -> Optional[_ParsedItems]:
+        """
+        _generate_json with a hedge: if the call hasn't finished after
+        hedge_after seconds, send an identical one and keep whichever
+        completes first (the other is cancelled).
+        """
+        if not self.hedge_enabled:
+            return await self._generate_json(prompt, items_path, catalog_context, max_output_tokens, resolve, max_results)
+        
+        first = asyncio.create_task(self._generate_json(prompt, items_path, catalog_context, max_output_tokens, resolve, max_results))
+        done, _ = await asyncio.wait({first}, timeout=self.hedge_after)
+        if done:
+            return first.result()
+        
+        log.info(f"Gemini call exceeded {self.hedge_after:.1f}s - sending hedged request")
+        second = asyncio.create_task(self._generate_json(prompt, items_path, catalog_context, max_output_tokens, resolve, max_results))
+        pending = {first, second}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                succeeded = [task for task in done if task.exception() is None]
+                if succeeded:
+                    return succeeded[0].result()
+                # A failed attempt only counts if the other one fails too
+                if not pending:
+                    return done.pop().result()
+        finally:
+            for task in pending:
+                task.cancel()
+    
+    async def _generate_json(
+        self,
+        prompt: str,
+        items_path: str,
+        catalog_context: Optional[str] = None,
+        max_output_tokens: Optional[int] = None,
+        resolve: Optional[_Resolver] = None,
+        max_results: Optional[int] = None
+    ) -> Optional[_ParsedItems]:
+        """
+        Call Gemini and stream-parse the array at items_path (ijson prefix,
+        e.g. "recommendations.item") out of the JSON object it returns.
+        Each item is passed to resolve as it is parsed, stopping once
+        max_results of them resolve.
+        
+        Returns None when the response is blocked, empty or unparseable.
+        """
+        config = types.GenerateContentConfig(
+            temperature=self.generation_config["temperature"],
+            max_output_tokens=max_output_tokens or self.generation_config["max_output_tokens"],
+            cached_content=catalog_context,
+            response_mime_type="application/json"  # Bare JSON, parseable from the first token
+        )
+        
+        # Stream by default; the single blocking call below is the fallback
+        try:
+            return await self._stream_json_items(prompt, items_path, config, resolve, max_results)
+        except Exception as e:
+            log.warning(f"Gemini streaming failed, falling back to a single call: {e}")
+        
+        # Generate response without blocking the event loop
+        response = await self.client.aio.models.generate_content(
+            model=self.model_name,
+            contents=prompt,
+            config=config
+        )
+        
+        # Log response structure for debugging (lazy: skipped unless DEBUG is enabled)
+        log.opt(lazy=True).debug("Gemini response type: {}", lambda: type(response))
+        
+        # Check if response was blocked
+        if not response.candidates:
+            log.error("Gemini response was blocked (safety filters or empty)")
+            if hasattr(response, 'prompt_feedback'):
+                feedback = response.prompt_feedback
+                log.error(f"Prompt feedback: block_reason={getattr(feedback, 'block_reason', 'unknown')}, safety_ratings={getattr(feedback, 'safety_ratings', [])}")
+            else:
+                log.debug("No prompt feedback available")
+            return None
+        
+        # Log candidate info for debugging
+        for i, candidate in enumerate(response.candidates):
+            log.opt(lazy=True).debug(
+                "Candidate {}: finish_reason={}, parts={}",
+                lambda: i,
+                lambda: getattr(candidate, 'finish_reason', 'N/A'),
+                lambda: len(candidate.content.parts or []) if getattr(candidate, 'content', None) else 0
+            )
+        
+        # Extract text from response (handle multi-part responses including "thinking" models)
+        response_text = ""
+        
+        # First try the direct .text accessor
+        try:
+            # google-genai skips "thinking" parts here and returns None when
+            # there is no text at all
+            response_text = response.text or ""
+            log.opt(lazy=True).debug("Got response using .text accessor, length: {}", lambda: len(response_text))
+        except Exception as e:
+            # Fall back to the parts accessor
+            log.debug(f"Exception with .text accessor: {type(e).__name__}: {e}")
+            try:
+                for candidate in response.candidates:
+                    if hasattr(candidate, 'content') and candidate.content:
+                        for part in candidate.content.parts:
+                            # Only text parts (not thinking/tool parts)
+                            if getattr(part, 'text', None) and not getattr(part, 'thought', False):
+                                response_text += part.text
+                                log.opt(lazy=True).debug("Extracted text from part: {}...", lambda: part.text[:100])
+            except Exception as ex:
+                log.error(f"Failed to extract text from parts: {ex}")
+                log.opt(lazy=True).error("Response object: {}", lambda: response)
+        
+        if not response_text or len(response_text.strip()) == 0:
+            log.error("Empty response from Gemini after text extraction")
+            log.opt(lazy=True).debug("Response candidates: {}", lambda: response.candidates)
+            # Full response structure (dir() of every candidate/part) only when asked for
+            if GEMINI_DEEP_DEBUG:
                 try:
                     for i, candidate in enumerate(response.candidates):
                         log.error(f"Candidate {i} structure: {dir(candidate)}")
                         if hasattr(candidate, 'content') and candidate.content:
-                            log.error(f"Content parts: {len(candidate.content.parts) if hasattr(candidate.content, 'parts') else 0}")
-                            for j, part in enumerate(candidate.content.parts):
+                            log.error(f"Content parts: {len(candidate.content.parts or [])}")
+                            for j, part in enumerate(candidate.content.parts or []):
                                 log.error(f"Part {j} type: {type(part)}, attributes: {dir(part)}")
                 except Exception as debug_ex:
                     log.error(f"Debug logging failed: {debug_ex}")
-                if hasattr(response, 'prompt_feedback'):
-                    log.error(f"Prompt feedback: {response.prompt_feedback}")
-                # Response is empty or blocked, return empty list
-                return []
-            
-            log.debug(f"Gemini raw response (first 200 chars): {response_text[:200]}")
-            
-            # Parse JSON response
-            # Remove markdown code blocks if present
-            response_text = response_text.strip()
-            if "```json" in response_text:
-                response_text = response_text.split("```json")[1].split("```")[0]
-            elif "```" in response_text:
-                response_text = response_text.split("```")[1].split("```")[0]
-            
-            response_text = response_text.strip()
-            
-            # Try to parse JSON
-            try:
-                result = json.loads(response_text)
-            except json.JSONDecodeError as e:
+            if hasattr(response, 'prompt_feedback'):
+                log.error(f"Prompt feedback: {response.prompt_feedback}")
+            # Response is empty or blocked
+            return None
+        
+        log.opt(lazy=True).debug("Gemini raw response (first 200 chars): {}", lambda: response_text[:200])
+        
+        # Parse JSON response
+        # Remove markdown code blocks if present
+        response_text = response_text.strip()
+        if "```json" in response_text:
+            response_text = response_text.split("```json")[1].split("```")[0]
+        elif "```" in response_text:
+            response_text = response_text.split("```")[1].split("```")[0]
+        
+        response_text = response_text.strip()
+        
+        # Parse only the array we need, item by item (no full document tree)
+        parsed = _ParsedItems([], complete=False)
+        try:
+            for item in ijson.items(io.BytesIO(response_text.encode("utf-8")), items_path, use_float=True):
+                if parsed.collect([item], resolve, max_results):
+                    break
+            parsed.complete = True
+        except ijson.JSONError as e:
+            if not parsed.items:
                 log.error(f"Failed to parse Gemini JSON response: {e}")
                 log.error(f"Response text: {response_text[:500]}")
-                return []
-            
-            if not result.get("recommendations"):
-                log.warning("No recommendations in Gemini response")
-                return []
-            
-            # Create recommendations
-            recommendations = []
-            assessment_map = {a.get('id'): a for a in assessments}
-            
-            for idx, rec in enumerate(result.get("recommendations", [])):
-                assessment_id = rec.get("id")
-                
-                # Try exact match first
-                assessment = assessment_map.get(assessment_id)
-                
-                # If not found, try fuzzy matching (case-insensitive, handle special chars)
-                if not assessment:
-                    # Try to find by name match or similar ID
-                    normalized_id = assessment_id.lower().replace('_', ' ').replace('-', ' ')
-                    for db_assessment in assessments:
-                        db_id = db_assessment.get('id', '').lower()
-                        db_name = db_assessment.get('name', '').lower()
-                        
-                        # Check if IDs are similar or if name matches
-                        if (normalized_id in db_id or db_id in normalized_id or 
-                            normalized_id in db_name or db_name in normalized_id):
-                            assessment = db_assessment
-                            log.info(f"Fuzzy matched '{assessment_id}' to '{db_assessment.get('id')}'")
-                            break
-                
-                if not assessment:
-                    log.warning(f"Assessment {assessment_id} not found (skipping)")
-                    continue
-                
-                # Apply filters
-                if request.remote_testing_required and not assessment.get('remote_testing', False):
-                    continue
-                
-                if request.max_duration and assessment.get('duration', 0) and assessment.get('duration', 0) > request.max_duration:
+                return None
+            # Truncated output (max_output_tokens hit) - keep the complete items
+            log.warning(f"Gemini JSON truncated after {len(parsed.items)} items: {e}")
+        
+        return parsed
+    
+    async def _stream_json_items(
+        self,
+        prompt: str,
+        items_path: str,
+        config: types.GenerateContentConfig,
+        resolve: Optional[_Resolver] = None,
+        max_results: Optional[int] = None
+    ) -> Optional[_ParsedItems]:
+        """
+        Stream the Gemini response into an incremental ijson parser so items
+        are parsed (and resolved) while tokens are still being generated. The
+        stream is closed as soon as max_results items have resolved.
+        
+        Returns None when nothing usable was streamed; API errors propagate.
+        """
+        items = ijson.sendable_list()
+        parser = ijson.items_coro(items, items_path, use_float=True)
+        parsed = _ParsedItems([], complete=False)
+        started = False
+        last_chunk = None
+        
+        try:
+            stream = await self.client.aio.models.generate_content_stream(
+                model=self.model_name,
+                contents=prompt,
+                config=config
+            )
+            async for chunk in stream:
+                last_chunk = chunk
+                text = chunk.text
+                if not text:
                     continue
-                
-                if request.language:
-                    languages = ['English']
-                    if request.language not in languages:
+                if not started:
+                    # Skip any preamble (e.g. a ```json fence) before the object
+                    start = text.find("{")
+                    if start < 0:
                         continue
-                
-                assessment_response = self._db_to_response(assessment)
-                
-                score = RecommendationScore(
-                    total_score=rec.get("relevance_score", 0.8),
-                    relevance_score=rec.get("relevance_score", 0.8),
-                    skill_match_score=rec.get("skill_match_score"),
-                    confidence=rec.get("relevance_score", 0.8),
-                    explanation=rec.get("explanation", "AI-recommended")
-                )
-                
-                recommendations.append(RecommendationItem(
-                    assessment=assessment_response,
-                    score=score,
-                    rank=idx + 1
-                ))
-            
-            log.info(f"Gemini returned {len(recommendations)} recommendations")
-            return recommendations
-            
-        except Exception as e:
-            log.error(f"Gemini recommendation error: {e}")
-            return []
+                    text = text[start:]
+                    started = True
+                parser.send(text.encode("utf-8"))
+                enough = parsed.collect(items, resolve, max_results)
+                del items[:]
+                if enough:
+                    # Everything the caller needs is in; stop generating the rest
+                    parsed.complete = True
+                    aclose = getattr(stream, "aclose", None)
+                    if aclose is not None:
+                        await aclose()
+                    break
+            else:
+                parser.close()
+                parsed.collect(items, resolve, max_results)
+                parsed.complete = True
+        except ijson.JSONError as e:
+            parsed.collect(items, resolve, max_results)
+            if not parsed.items:
+                log.error(f"Failed to parse streamed Gemini JSON: {e}")
+                return None
+            # Truncated output or a trailing fence - keep the complete items
+            log.warning(f"Gemini JSON stream ended early after {len(parsed.items)} items: {e}")
+        
+        if not started:
+            log.error("Empty response from Gemini stream (blocked or no text)")
+            feedback = getattr(last_chunk, 'prompt_feedback', None)
+            if feedback:
+                log.error(f"Prompt feedback: {feedback}")
+            return None
+        
+        log.debug(f"Streamed {len(parsed.items)} items from Gemini")
+        return parsed
+    
+    def _get_catalog_snapshot(
+        self,
+        assessments: List[dict]
+    ) -> Tuple[Dict[str, dict], Dict[str, dict], Dict[str, AssessmentResponse]]:
+        """
+        Lookup maps and converted responses for the assessments table,
+        rebuilt only when an id or updated_at changes.
+        """
+        signature = hash(tuple((a.get('id'), a.get('updated_at')) for a in assessments))
+        if self._catalog_snapshot is not None and self._catalog_snapshot[0] == signature:
+            return self._catalog_snapshot[1:]
+        
+        assessment_map = {a.get('id'): a for a in assessments}
+        fuzzy_map = self._build_fuzzy_map(assessments)
+        responses = {a.get('id'): self._db_to_response(a) for a in assessments if a.get('id')}
+        self._catalog_snapshot = (signature, assessment_map, fuzzy_map, responses)
+        log.debug(f"Rebuilt Gemini catalog snapshot ({len(assessments)} assessments)")
+        return assessment_map, fuzzy_map, responses
+    
+    @staticmethod
+    def _normalize_key(value: str) -> str:
+        """Lowercase and treat '_' / '-' as spaces for id/name matching"""
+        return value.lower().replace('_', ' ').replace('-', ' ').strip()
+    
+    def _build_fuzzy_map(self, assessments: List[dict]) -> Dict[str, dict]:
+        """Index assessments by normalized id and name (ids win on collisions)"""
+        fuzzy_map = {}
+        for a in assessments:
+            if a.get('name'):
+                fuzzy_map.setdefault(self._normalize_key(a['name']), a)
+        for a in assessments:
+            if a.get('id'):
+                fuzzy_map[self._normalize_key(a['id'])] = a
+        return fuzzy_map
     
     def _db_to_response(self, assessment: dict) -> AssessmentResponse:
         """Convert database model to response schema"""
@@ -1,22 +1,52 @@
 """
 GitHub Profile Analyzer - Extracts skills and experience from GitHub profiles
 """
+import asyncio
 import re
 import httpx
-from typing import Dict, List, Optional
+import diskcache
+import ahocorasick
+from cachetools import TTLCache
+from typing import Dict, List, Optional, Tuple
 from app.core.logging import log
 
 
+# Username segment of a GitHub profile/repo URL
+_GH_USER_RE = re.compile(r'github\.com/([^/\s?#]+)')
+
+# Keyword payload bits: topic/skill lists; specialization categories start at _CATEGORY_BIT0
+_TOPIC_BIT = 1 << 0
+_SKILL_BIT = 1 << 1
+_CATEGORY_BIT0 = 2
+
+# Page number of the rel="last" entry in a GitHub Link header
+_LAST_PAGE_RE = re.compile(r'[?&]page=(\d+)[^>]*>;\s*rel="last"')
+
+
 class GitHubAnalyzer:
     """
     Analyzes GitHub profiles to extract programming languages, skills, and activity
     """
     
-    def __init__(self, github_token: Optional[str] = None):
+    def __init__(self, github_token: Optional[str] = None, cache_dir: str = "/tmp/gh_cache"):
         """Initialize GitHub analyzer"""
         self.github_token = github_token
         self.api_base = "https://api.github.com"
         
+        # Shared client: one connection pool (HTTP/2, keep-alive) for every call
+        self._client = httpx.AsyncClient(
+            http2=True,
+            timeout=10.0,
+            headers={'Authorization': f'token {github_token}'} if github_token else {},
+            limits=httpx.Limits(max_keepalive_connections=20)
+        )
+        
+        # Finished analyses per lowercase username (only successful ones are stored)
+        self._profile_cache: TTLCache = TTLCache(maxsize=1024, ttl=3600)
+        
+        # Conditional-request cache: URL -> validators + body (304s are free against the rate limit)
+        self._etag_cache = diskcache.Cache(cache_dir, size_limit=64 * 1024 * 1024)
+        
         # Language to skill mapping
         self.language_skills = {
             'Python': ['Python', 'Django', 'Flask', 'FastAPI', 'Data Science', 'Machine Learning'],
@@ -36,6 +66,47 @@ class GitHubAnalyzer:
             'SQL': ['SQL', 'Database', 'MySQL', 'PostgreSQL'],
             'Shell': ['DevOps', 'Automation', 'Linux', 'System Administration']
         }
+        
+        # Frameworks/tools picked up from topics and from repo names/descriptions
+        self.topic_keywords = ['react', 'vue', 'angular', 'django', 'flask', 'spring', 'docker', 'kubernetes']
+        self.skill_keywords = ['docker', 'kubernetes', 'aws', 'azure', 'react', 'vue', 'angular', 'django', 'flask', 'spring', 'tensorflow', 'pytorch']
+        
+        # Specialization categories and their trigger keywords
+        self.specialization_keywords = {
+            'Web Development': ['website', 'web', 'frontend', 'backend', 'fullstack'],
+            'Mobile Development': ['android', 'ios', 'mobile', 'app'],
+            'Data Science': ['data', 'analysis', 'visualization', 'analytics', 'ml', 'machine-learning'],
+            'Machine Learning': ['ml', 'ai', 'deep-learning', 'neural', 'tensorflow', 'pytorch'],
+            'DevOps': ['devops', 'ci-cd', 'docker', 'kubernetes', 'terraform', 'deployment'],
+            'Cloud': ['aws', 'azure', 'gcp', 'cloud'],
+            'Game Development': ['game', 'unity', 'unreal', 'gamedev']
+        }
+        
+        # One bit per specialization category, so a repo's matches fold into one int
+        self._category_bits = [
+            (category, 1 << (_CATEGORY_BIT0 + i))
+            for i, category in enumerate(self.specialization_keywords)
+        ]
+        
+        # One automaton over every keyword: a single pass per text finds all substring hits
+        self._aho = self._build_keyword_automaton()
+    
+    def _build_keyword_automaton(self) -> ahocorasick.Automaton:
+        """Build an Aho-Corasick automaton mapping each keyword to (keyword, bitmask)"""
+        mask_by_keyword: Dict[str, int] = {}
+        for keyword in self.topic_keywords:
+            mask_by_keyword[keyword] = mask_by_keyword.get(keyword, 0) | _TOPIC_BIT
+        for keyword in self.skill_keywords:
+            mask_by_keyword[keyword] = mask_by_keyword.get(keyword, 0) | _SKILL_BIT
+        for category, bit in self._category_bits:
+            for keyword in self.specialization_keywords[category]:
+                mask_by_keyword[keyword] = mask_by_keyword.get(keyword, 0) | bit
+        
+        automaton = ahocorasick.Automaton()
+        for keyword, mask in mask_by_keyword.items():
+            automaton.add_word(keyword, (keyword, mask))
+        automaton.make_automaton()
+        return automaton
     
     async def analyze_profile(self, github_url: str) -> Dict:
         """
@@ -56,27 +127,46 @@ class GitHubAnalyzer:
                 log.warning("Could not extract username from GitHub URL")
                 return self._empty_result()
             
-            # Fetch user data and repositories
-            user_data = await self._fetch_user_data(username)
-            repos = await self._fetch_repositories(username)
+            cache_key = username.lower()
+            cached = self._profile_cache.get(cache_key)
+            if cached is not None:
+                log.info(f"GitHub profile cache hit: {username}")
+                return cached
+            
+            # Fetch user data and repositories concurrently
+            user_data, repos = await asyncio.gather(
+                self._fetch_user_data(username),
+                self._fetch_repositories(username)
+            )
             
             if not user_data or not repos:
                 log.warning("Failed to fetch GitHub data")
+                self._profile_cache.pop(cache_key, None)
                 return self._empty_result()
             
-            # Analyze data
+            # Lowercase/join each repo's text once, shared by both keyword scans
+            normalized = [self._normalize_repo(repo) for repo in repos]
+            
+            # Analyze data in worker threads so the event loop keeps serving requests
+            skills, specializations, job_level = await asyncio.gather(
+                asyncio.to_thread(self._extract_skills_from_repos, repos, normalized),
+                asyncio.to_thread(self._determine_specializations, normalized),
+                asyncio.to_thread(self._determine_experience_level, user_data, repos)
+            )
+            
             result = {
-                'skills': self._extract_skills_from_repos(repos),
+                'skills': skills,
                 'languages': self._extract_languages(repos),
                 'total_repos': len(repos),
                 'total_stars': sum(repo.get('stargazers_count', 0) for repo in repos),
                 'contributions': user_data.get('public_repos', 0),
                 'bio': user_data.get('bio', ''),
-                'job_level': self._determine_experience_level(user_data, repos),
-                'specializations': self._determine_specializations(repos)
+                'job_level': job_level,
+                'specializations': specializations
             }
             
             log.info(f"✅ Extracted from GitHub: {len(result['skills'])} skills, {len(result['languages'])} languages, level: {result['job_level']}")
+            self._profile_cache[cache_key] = result
             return result
             
         except Exception as e:
@@ -85,37 +175,19 @@ class GitHubAnalyzer:
     
     def _extract_username(self, github_url: str) -> Optional[str]:
         """Extract username from GitHub URL"""
-        patterns = [
-            r'github\.com/([^/]+)/?$',
-            r'github\.com/([^/]+)/.*'
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, github_url)
-            if match:
-                return match.group(1)
-        
-        return None
+        match = _GH_USER_RE.search(github_url)
+        return match.group(1) if match else None
     
     async def _fetch_user_data(self, username: str) -> Optional[Dict]:
         """Fetch user data from GitHub API"""
         try:
-            headers = {}
-            if self.github_token:
-                headers['Authorization'] = f'token {self.github_token}'
-            
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    f"{self.api_base}/users/{username}",
-                    headers=headers,
-                    timeout=10.0
-                )
-                
-                if response.status_code == 200:
-                    return response.json()
-                else:
-                    log.warning(f"GitHub API returned status {response.status_code}")
-                    return None
+            response = await self._get(f"{self.api_base}/users/{username}")
+            
+            if response.status_code == 200:
+                return response.json()
+            else:
+                log.warning(f"GitHub API returned status {response.status_code}")
+                return None
                     
         except Exception as e:
             log.error(f"Error fetching user data: {e}")
@@ -124,28 +196,76 @@ class GitHubAnalyzer:
     async def _fetch_repositories(self, username: str) -> List[Dict]:
         """Fetch user repositories from GitHub API"""
         try:
-            headers = {}
-            if self.github_token:
-                headers['Authorization'] = f'token {self.github_token}'
-            
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    f"{self.api_base}/users/{username}/repos",
-                    headers=headers,
-                    params={'per_page': 100, 'sort': 'updated'},
-                    timeout=10.0
-                )
-                
-                if response.status_code == 200:
-                    return response.json()
-                else:
-                    log.warning(f"GitHub API returned status {response.status_code}")
-                    return []
+            url = f"{self.api_base}/users/{username}/repos"
+            params = {'per_page': 100, 'sort': 'updated'}
+            response = await self._get(url, params=params)
+            
+            if response.status_code != 200:
+                log.warning(f"GitHub API returned status {response.status_code}")
+                return []
+            
+            repos = response.json()
+            
+            # Fan out the remaining pages concurrently (Link header only present when paginated)
+            match = _LAST_PAGE_RE.search(response.headers.get('Link', ''))
+            if match:
+                last_page = int(match.group(1))
+                pages = await asyncio.gather(*(
+                    self._get(url, params={**params, 'page': page})
+                    for page in range(2, last_page + 1)
+                ))
+                for page_response in pages:
+                    if page_response.status_code == 200:
+                        repos.extend(page_response.json())
+                    else:
+                        log.warning(f"GitHub API returned status {page_response.status_code} for a repos page")
+            
+            return repos
                     
         except Exception as e:
             log.error(f"Error fetching repositories: {e}")
             return []
     
+    async def _get(self, url: str, params: Optional[Dict] = None) -> httpx.Response:
+        """GET with If-None-Match / If-Modified-Since, serving 304s from the disk cache"""
+        key = str(httpx.URL(url, params=params))
+        cached = self._etag_cache.get(key)
+        
+        headers = {}
+        if cached:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            elif cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+        
+        response = await self._client.get(url, params=params, headers=headers)
+        
+        if response.status_code == 304 and cached:
+            return httpx.Response(
+                200,
+                content=cached['body'],
+                headers={'Content-Type': 'application/json', 'Link': cached.get('link', '')},
+                request=response.request
+            )
+        
+        if response.status_code == 200:
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+            if etag or last_modified:
+                self._etag_cache.set(key, {
+                    'etag': etag,
+                    'last_modified': last_modified,
+                    'link': response.headers.get('Link', ''),
+                    'body': response.content
+                })
+        
+        return response
+    
+    async def aclose(self):
+        """Close the shared HTTP client and the response cache"""
+        await self._client.aclose()
+        self._etag_cache.close()
+    
     def _extract_languages(self, repos: List[Dict]) -> List[str]:
         """Extract programming languages from repositories"""
         languages = set()
@@ -157,31 +277,33 @@ class GitHubAnalyzer:
         
         return sorted(list(languages))
     
-    def _extract_skills_from_repos(self, repos: List[Dict]) -> List[str]:
+    def _normalize_repo(self, repo: Dict) -> Tuple[str, str, List[str], str]:
+        """Lowercased (name, description, topics, combined text) for keyword scans"""
+        name = (repo.get('name') or '').lower()
+        desc = (repo.get('description') or '').lower()
+        topics = [topic.lower() for topic in repo.get('topics') or []]
+        return name, desc, topics, f"{name} {desc} {' '.join(topics)}"
+    
+    def _extract_skills_from_repos(self, repos: List[Dict], normalized: List[Tuple[str, str, List[str], str]]) -> List[str]:
         """Extract skills based on repository languages and topics"""
         skills = set()
         
         # Extract from languages
-        for repo in repos:
+        for repo, (name, desc, topics, _) in zip(repos, normalized):
             lang = repo.get('language')
             if lang and lang in self.language_skills:
                 skills.update(self.language_skills[lang])
             
-            # Extract from topics/tags
-            topics = repo.get('topics', [])
+            # Extract from topics/tags (title() ignores the original casing anyway)
             for topic in topics:
-                if any(tech in topic.lower() for tech in ['react', 'vue', 'angular', 'django', 'flask', 'spring', 'docker', 'kubernetes']):
+                if any(mask & _TOPIC_BIT for _, (_, mask) in self._aho.iter(topic)):
                     skills.add(topic.title())
             
-            # Extract from repo names and descriptions
-            name = repo.get('name', '').lower()
-            desc = repo.get('description', '').lower() if repo.get('description') else ''
-            
-            # Common frameworks and tools
-            keywords = ['docker', 'kubernetes', 'aws', 'azure', 'react', 'vue', 'angular', 'django', 'flask', 'spring', 'tensorflow', 'pytorch']
-            for keyword in keywords:
-                if keyword in name or keyword in desc:
-                    skills.add(keyword.title())
+            # Extract from repo names and descriptions (scanned separately, as before)
+            for text in (name, desc):
+                for _, (keyword, mask) in self._aho.iter(text):
+                    if mask & _SKILL_BIT:
+                        skills.add(keyword.title())
         
         return sorted(list(skills))
     
@@ -204,32 +326,20 @@ class GitHubAnalyzer:
         else:
             return 'Entry Level'
     
-    def _determine_specializations(self, repos: List[Dict]) -> List[str]:
+    def _determine_specializations(self, normalized: List[Tuple[str, str, List[str], str]]) -> List[str]:
         """Determine technical specializations from repositories"""
         specializations = set()
         
         # Count repos by category
-        categories = {
-            'Web Development': ['website', 'web', 'frontend', 'backend', 'fullstack'],
-            'Mobile Development': ['android', 'ios', 'mobile', 'app'],
-            'Data Science': ['data', 'analysis', 'visualization', 'analytics', 'ml', 'machine-learning'],
-            'Machine Learning': ['ml', 'ai', 'deep-learning', 'neural', 'tensorflow', 'pytorch'],
-            'DevOps': ['devops', 'ci-cd', 'docker', 'kubernetes', 'terraform', 'deployment'],
-            'Cloud': ['aws', 'azure', 'gcp', 'cloud'],
-            'Game Development': ['game', 'unity', 'unreal', 'gamedev']
-        }
-        
-        category_scores = {cat: 0 for cat in categories}
+        category_scores = {cat: 0 for cat in self.specialization_keywords}
         
-        for repo in repos:
-            name = repo.get('name', '').lower()
-            desc = repo.get('description', '').lower() if repo.get('description') else ''
-            topics = ' '.join(repo.get('topics', [])).lower()
-            
-            combined_text = f"{name} {desc} {topics}"
-            
-            for category, keywords in categories.items():
-                if any(keyword in combined_text for keyword in keywords):
+        for _, _, _, combined_text in normalized:
+            # Each category counts at most once per repo
+            repo_mask = 0
+            for _, (_, mask) in self._aho.iter(combined_text):
+                repo_mask |= mask
+            for category, bit in self._category_bits:
+                if repo_mask & bit:
                     category_scores[category] += 1
         
         # Get top specializations
@@ -1,16 +1,24 @@
 """
 Hybrid recommendation engine combining multiple approaches
 """
+import asyncio
+import hashlib
+import json
 from typing import List, Dict
-from collections import defaultdict
+import numpy as np
+from cachetools import TTLCache
 
 from app.models.schemas import RecommendationRequest, RecommendationItem, RecommendationScore
-from app.services.rag_recommender_v2 import RAGRecommender
+from app.services.rag_recommender_v2 import get_rag_recommender
 from app.services.nlp_recommender import NLPRecommender
 from app.services.clustering_recommender import ClusteringRecommender
 from app.services.gemini_recommender import GeminiRecommender
+from app.core.config import get_settings
 from app.core.logging import log
 
+# Display names for per-engine log lines
+ENGINE_LABELS = {"rag": "RAG", "nlp": "NLP", "clustering": "Clustering", "gemini": "Gemini"}
+
 
 class HybridRecommender:
     """
@@ -20,7 +28,7 @@ class HybridRecommender:
     
     def __init__(self, rag_recommender=None, nlp_recommender=None, clustering_recommender=None, gemini_recommender=None):
         """Initialize hybrid recommender with pre-initialized engines"""
-        self.rag_recommender = rag_recommender or RAGRecommender()
+        self.rag_recommender = rag_recommender or get_rag_recommender()
         self.nlp_recommender = nlp_recommender or NLPRecommender()
         self.clustering_recommender = clustering_recommender or ClusteringRecommender()
         self.gemini_recommender = gemini_recommender or GeminiRecommender()
@@ -32,6 +40,15 @@ class HybridRecommender:
             "clustering": 0.20,  # Pattern recognition
             "gemini": 0.10    # AI insights - bonus
         }
+        # Same weights as a vector over a fixed engine order, for the score matrix
+        self._engine_order = tuple(ENGINE_LABELS)
+        self._base_weights_arr = np.array([self.base_weights[engine] for engine in self._engine_order], dtype=np.float64)
+        
+        # LRU of final recommendation lists per normalized request. Entries expire
+        # with the vector table snapshot they were built from.
+        self._result_cache: "TTLCache[bytes, List[RecommendationItem]]" = TTLCache(
+            maxsize=512, ttl=get_settings().vector_table_cache_ttl
+        )
     
     async def recommend(
         self, 
@@ -48,68 +65,61 @@ class HybridRecommender:
         Returns:
             Combined and re-ranked recommendations
         """
-        log.info(f"Hybrid recommendation for: {request.dict()}")
+        log.opt(lazy=True).debug("Hybrid recommendation for: {}", lambda: request.model_dump())
+        
+        cache_key = self._request_cache_key(request)
+        cached = self._result_cache.get(cache_key)
+        if cached is not None:
+            log.info("Hybrid result cache hit")
+            # Copies, so callers can't mutate the cached items (e.g. rank)
+            return [item.model_copy(deep=True) for item in cached]
         
         # Extract keywords from query for strict filtering
         query_keywords = self._extract_keywords(request)
         log.info(f"Extracted keywords for filtering: {query_keywords}")
         
-        # Get recommendations from each engine
-        recommendations_by_engine = {}
+        # Get recommendations from each engine - the engines are independent,
+        # so run them concurrently (latency = slowest engine, not the sum)
+        engine_calls = {
+            "rag": self._call_engine(self.rag_recommender, request, db),
+            "nlp": self._call_engine(self.nlp_recommender, request, db),
+            "clustering": self._call_engine(self.clustering_recommender, request, db),
+        }
+        # Gemini recommendations (if available)
+        if self.gemini_recommender.client:
+            engine_calls["gemini"] = self._call_engine(self.gemini_recommender, request, db)
         
-        # RAG recommendations
-        try:
-            rag_recs = await self.rag_recommender.recommend(request, db)
-            # Apply strict keyword filter
-            rag_recs = self._filter_by_keywords(rag_recs, query_keywords)
-            recommendations_by_engine["rag"] = rag_recs
-            log.info(f"RAG contributed {len(rag_recs)} recommendations (after keyword filter)")
-        except Exception as e:
-            log.error(f"RAG recommender error: {e}")
-            recommendations_by_engine["rag"] = []
+        results = await asyncio.gather(*engine_calls.values(), return_exceptions=True)
         
-        # NLP recommendations
-        try:
-            nlp_recs = await self.nlp_recommender.recommend(request, db)
+        recommendations_by_engine = {"rag": [], "nlp": [], "clustering": [], "gemini": []}
+        for engine, result in zip(engine_calls.keys(), results):
+            if isinstance(result, Exception):
+                log.error(f"{ENGINE_LABELS[engine]} recommender error: {result}")
+                continue
             # Apply strict keyword filter
-            nlp_recs = self._filter_by_keywords(nlp_recs, query_keywords)
-            recommendations_by_engine["nlp"] = nlp_recs
-            log.info(f"NLP contributed {len(nlp_recs)} recommendations (after keyword filter)")
-        except Exception as e:
-            log.error(f"NLP recommender error: {e}")
-            recommendations_by_engine["nlp"] = []
-        
-        # Clustering recommendations
-        try:
-            clustering_recs = await self.clustering_recommender.recommend(request, db)
-            # Apply strict keyword filter
-            clustering_recs = self._filter_by_keywords(clustering_recs, query_keywords)
-            recommendations_by_engine["clustering"] = clustering_recs
-            log.info(f"Clustering contributed {len(clustering_recs)} recommendations (after keyword filter)")
-        except Exception as e:
-            log.error(f"Clustering recommender error: {e}")
-            recommendations_by_engine["clustering"] = []
-        
-        # Gemini recommendations (if available)
-        try:
-            if self.gemini_recommender.model:
-                gemini_recs = await self.gemini_recommender.recommend(request, db)
-                # Apply strict keyword filter
-                gemini_recs = self._filter_by_keywords(gemini_recs, query_keywords)
-                recommendations_by_engine["gemini"] = gemini_recs
-                log.info(f"Gemini contributed {len(gemini_recs)} recommendations (after keyword filter)")
-            else:
-                recommendations_by_engine["gemini"] = []
-        except Exception as e:
-            log.error(f"Gemini recommender error: {e}")
-            recommendations_by_engine["gemini"] = []
+            engine_recs = self._filter_by_keywords(result, query_keywords)
+            recommendations_by_engine[engine] = engine_recs
+            log.info(f"{ENGINE_LABELS[engine]} contributed {len(engine_recs)} recommendations (after keyword filter)")
         
         # Combine recommendations
         combined = self._combine_recommendations(recommendations_by_engine, request.num_recommendations)
         
         log.info(f"Hybrid returned {len(combined)} recommendations")
+        
+        # Empty results usually mean failing engines - don't pin them
+        if combined:
+            self._result_cache[cache_key] = [item.model_copy(deep=True) for item in combined]
         return combined
     
+    def _request_cache_key(self, request: RecommendationRequest) -> bytes:
+        """Digest of the request fields that affect results (user_id is tracking only)"""
+        payload = json.dumps(request.model_dump(mode="json", exclude={"user_id"}), sort_keys=True, default=str)
+        return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).digest()
+    
+    async def _call_engine(self, engine, request: RecommendationRequest, db) -> List[RecommendationItem]:
+        """Await one engine; any error (even a synchronous one) surfaces through gather"""
+        return await engine.recommend(request, db)
+    
     def _extract_keywords(self, request: RecommendationRequest) -> set:
         """Extract relevant keywords from the request for strict filtering"""
         keywords = set()
@@ -176,94 +186,85 @@ class HybridRecommender:
         Uses dynamic weighting based on which engines contributed results
         """
         # Calculate active engines and adjust weights dynamically
-        active_engines = {k: v for k, v in recommendations_by_engine.items() if v}
+        active_mask = np.array([bool(recommendations_by_engine.get(engine)) for engine in self._engine_order])
         
-        if not active_engines:
+        if not active_mask.any():
             log.warning("No recommendations from any engine")
             return []
         
         # Redistribute weights among active engines
-        total_base_weight = sum(self.base_weights.get(engine, 0.25) for engine in active_engines.keys())
-        adjusted_weights = {
-            engine: self.base_weights.get(engine, 0.25) / total_base_weight
-            for engine in active_engines.keys()
-        }
+        weights = self._base_weights_arr[active_mask]
+        weights = weights / weights.sum()
+        engines = [engine for engine, active in zip(self._engine_order, active_mask) if active]
         
-        log.info(f"Active engines: {list(active_engines.keys())}, Adjusted weights: {adjusted_weights}")
+        log.info(f"Active engines: {engines}, Adjusted weights: {weights.round(3).tolist()}")
         
-        # Collect scores for each assessment
-        assessment_scores = defaultdict(lambda: {
-            "total_score": 0.0,
-            "count": 0,
-            "engines": [],
-            "assessment": None,
-            "score_details": {},
-            "max_individual_score": 0.0
-        })
+        # Score matrix: one row per unique assessment (first-seen order), one
+        # column per active engine
+        assessments = {}
+        for engine in engines:
+            for rec in recommendations_by_engine[engine]:
+                assessments.setdefault(rec.assessment.id, rec.assessment)
+        ids = list(assessments.keys())
+        id_idx = {assessment_id: i for i, assessment_id in enumerate(ids)}
         
-        for engine, recommendations in active_engines.items():
-            weight = adjusted_weights[engine]
-            
-            for rec in recommendations:
-                assessment_id = rec.assessment.id
-                
-                # Store assessment object
-                if assessment_scores[assessment_id]["assessment"] is None:
-                    assessment_scores[assessment_id]["assessment"] = rec.assessment
-                
-                # Weighted score
-                weighted_score = rec.score.total_score * weight
-                assessment_scores[assessment_id]["total_score"] += weighted_score
-                assessment_scores[assessment_id]["count"] += 1
-                assessment_scores[assessment_id]["engines"].append(engine)
-                assessment_scores[assessment_id]["score_details"][engine] = rec.score.total_score
-                assessment_scores[assessment_id]["max_individual_score"] = max(
-                    assessment_scores[assessment_id]["max_individual_score"],
-                    rec.score.total_score
-                )
+        scores = np.zeros((len(ids), len(engines)), dtype=np.float64)
+        present = np.zeros((len(ids), len(engines)), dtype=bool)
+        for e_idx, engine in enumerate(engines):
+            for rec in recommendations_by_engine[engine]:
+                row = id_idx[rec.assessment.id]
+                # An engine listing an assessment twice keeps its best score
+                if not present[row, e_idx] or rec.score.total_score > scores[row, e_idx]:
+                    scores[row, e_idx] = rec.score.total_score
+                present[row, e_idx] = True
         
-        # Create final recommendations with LinkedIn-style scoring
-        final_recommendations = []
+        weighted_total = (scores * present) @ weights
+        counts = present.sum(axis=1)
+        max_individual = np.maximum(np.where(present, scores, 0.0).max(axis=1), 0.0)
         
-        for assessment_id, data in assessment_scores.items():
-            # Multi-engine consensus bonus (like LinkedIn's collaborative signals)
-            consensus_bonus = 0.15 * min(data["count"] - 1, 2)  # Cap bonus at 2 extra engines
-            
-            # High individual score bonus (one engine really confident)
-            confidence_bonus = 0.1 if data["max_individual_score"] > 0.8 else 0
-            
-            # Calculate final score with bonuses
-            final_score = data["total_score"] + consensus_bonus + confidence_bonus
-            
-            # Create detailed explanation
-            engines_str = ", ".join(data["engines"])
-            engine_scores = ", ".join([f"{e}:{s:.2f}" for e, s in data["score_details"].items()])
-            explanation = f"🎯 Matched by {len(data['engines'])} engine(s): {engines_str} | Scores: [{engine_scores}] | Consensus: {final_score:.2f}"
-            
-            # Confidence based on how many engines agreed
-            confidence_score = min(1.0, (data["count"] / len(active_engines)) + 0.2)
-            
-            score = RecommendationScore(
-                total_score=final_score,
-                relevance_score=data["total_score"],
-                confidence=confidence_score,
-                explanation=explanation
-            )
-            
-            final_recommendations.append(RecommendationItem(
-                assessment=data["assessment"],
-                score=score,
-                rank=0  # Will be updated after sorting
-            ))
+        # Multi-engine consensus bonus (like LinkedIn's collaborative signals), capped at 2 extra engines
+        consensus_bonus = 0.15 * np.minimum(counts - 1, 2)
+        # High individual score bonus (one engine really confident)
+        confidence_bonus = np.where(max_individual > 0.8, 0.1, 0.0)
+        # Calculate final score with bonuses
+        final_scores = weighted_total + consensus_bonus + confidence_bonus
+        # Confidence based on how many engines agreed
+        confidence_scores = np.minimum(1.0, counts / len(engines) + 0.2)
         
-        # Sort by total score (with bonuses)
-        final_recommendations.sort(key=lambda x: x.score.total_score, reverse=True)
+        # Top-K by total score (with bonuses): O(N) partition, then sort only K;
+        # ties keep first-seen order
+        k = min(num_results, len(ids))
+        if k < len(ids):
+            # Everything scoring at least the k-th best (keeps boundary ties)
+            kth_score = -np.partition(-final_scores, k - 1)[k - 1]
+            top = np.flatnonzero(final_scores >= kth_score)
+        else:
+            top = np.arange(len(ids))
+        order = top[np.lexsort((top, -final_scores[top]))][:k]
         
-        # Update ranks and limit results
-        final_recommendations = final_recommendations[:num_results]
-        for idx, rec in enumerate(final_recommendations):
-            rec.rank = idx + 1
+        # Create final recommendations with LinkedIn-style scoring - objects and
+        # explanation strings only for the top results
+        final_recommendations = [
+            RecommendationItem(
+                assessment=assessments[ids[row]],
+                score=RecommendationScore(
+                    total_score=float(final_scores[row]),
+                    relevance_score=float(weighted_total[row]),
+                    confidence=float(confidence_scores[row]),
+                    explanation=self._format_explanation(engines, scores[row], present[row], float(final_scores[row]))
+                ),
+                rank=rank
+            )
+            for rank, row in enumerate(order, start=1)
+        ]
         
-        log.info(f"Combined {len(assessment_scores)} unique assessments into {len(final_recommendations)} final recommendations")
+        log.info(f"Combined {len(ids)} unique assessments into {len(final_recommendations)} final recommendations")
         
         return final_recommendations
+    
+    def _format_explanation(self, engines: List[str], row_scores: np.ndarray, row_present: np.ndarray, final_score: float) -> str:
+        """Detailed explanation of which engines matched and how they scored"""
+        matched = np.flatnonzero(row_present)
+        engines_str = ", ".join(engines[e] for e in matched)
+        engine_scores = ", ".join(f"{engines[e]}:{row_scores[e]:.2f}" for e in matched)
+        return f"🎯 Matched by {len(matched)} engine(s): {engines_str} | Scores: [{engine_scores}] | Consensus: {final_score:.2f}"
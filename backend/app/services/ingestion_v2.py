@@ -2,11 +2,16 @@
 Unified Ingestion Script for Both ChromaDB and Supabase
 Supports switching backends via VECTOR_DB_TYPE environment variable
 """
-import json
+import asyncio
 import os
+import re
 import sys
 from pathlib import Path
-from typing import List, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional
+import ijson
+import orjson
+import numpy as np
 from tqdm import tqdm
 from dotenv import load_dotenv
 
@@ -17,9 +22,11 @@ load_dotenv()
 COLLECTION_NAME = "shl_assessments"
 EMBEDDING_MODEL = "BAAI/bge-small-en-v1.5"
 VECTOR_DB_TYPE = os.getenv("VECTOR_DB_TYPE", "chromadb").lower()
+FORCE_REINDEX = os.getenv("FORCE_REINDEX", "false").lower() == "true"
 
 # Paths
 BASE_DIR = Path(__file__).parent.parent.parent  # backend/
+BACKEND_DIR = Path(__file__).resolve().parents[2]  # Import root for app.*
 DATA_FILE_PATH = BASE_DIR / "backend" / "data" / "shl_products_complete.json"
 
 # Adjust if running inside container structure where backend might be CWD
@@ -27,6 +34,11 @@ if not DATA_FILE_PATH.exists():
     # Try alternate path if CWD is backend/
     DATA_FILE_PATH = Path("data/shl_products_complete.json")
 
+# Job level inference from assessment names
+_DIGIT_RE = re.compile(r"(\d+)")
+_ENTRY_KWS = ("graduate", "entry", "intern", "junior", "apprentice")
+_SENIOR_KWS = ("manager", "senior", "lead", "head", "director", "executive", "vp")
+
 
 def clean_duration(val: Any) -> int:
     if val is None:
@@ -35,8 +47,7 @@ def clean_duration(val: Any) -> int:
         return val
     if isinstance(val, str):
         # Try to parse "11 minutes" etc.
-        import re
-        match = re.search(r"(\d+)", val)
+        match = _DIGIT_RE.search(val)
         if match:
             return int(match.group(1))
     return 0
@@ -49,150 +60,217 @@ def load_and_filter_data() -> List[Dict[str, Any]]:
         print(f"ERROR: File not found at {DATA_FILE_PATH}")
         sys.exit(1)
 
-    with open(DATA_FILE_PATH, "r", encoding="utf-8") as f:
-        content = json.load(f)
-        
-    # Content is {"metadata": ..., "assessments": [...]}
-    data_list = content.get("assessments", [])
-    print(f"Loaded {len(data_list)} raw assessments.")
-    
     valid_data = []
+    raw_count = 0
     
-    for item in data_list:
-        # Filter logic
-        # Requirement: Filter out "Pre-packaged Job Solutions"
-        # The file has a "type" field
-        atype = item.get("type", "")
-        if "Pre-packaged" in atype or "Job Solution" in atype:
-            if atype != "Individual Test Solution":  # Keep Individual Test Solutions
-                continue
-                
-        # Also check name/categorization if type is ambiguous
-        if item.get("job_family") == "Pre-packaged Job Solutions":
-             continue
-
-        # Extract Fields
-        name = item.get("name", "")
-        
-        # INFER JOB LEVEL
-        name_lower = name.lower()
-        job_level = "General"
-        if any(x in name_lower for x in ["graduate", "entry", "intern", "junior", "apprentice"]):
-            job_level = "Entry_Level"
-        elif any(x in name_lower for x in ["manager", "senior", "lead", "head", "director", "executive", "vp"]):
-            job_level = "Manager_Senior"
-            
-        description = item.get("description", "")
-        url_id = item.get('id', '').replace('_', '-')
-        url = f"https://www.shl.com/solutions/products/product-catalog/view/{url_id}/"  # Reconstruct URL if missing
-        
-        duration = clean_duration(item.get("duration"))
-        adaptive = "Yes" if item.get("adaptive") else "No"
-        remote = "Yes" if item.get("remote_testing") else "No"
-        
-        test_types = item.get("test_types", [])
-        test_type_str = test_types[0] if test_types else "General"
-        
-        # Create full text for embedding
-        # Title + Description + Keywords
-        full_text = f"{name}. {description}. {test_type_str}"
-        
-        record = {
-            "name": name,
-            "url": url,
-            "description": description,
-            "duration": duration,
-            "adaptive_support": adaptive,
-            "remote_support": remote,
-            "test_type": test_type_str, 
-            "full_text": full_text,
-            "job_level": job_level
-        }
-        valid_data.append(record)
-        
+    # Content is {"metadata": ..., "assessments": [...]} - stream the assessments
+    # one at a time instead of loading the whole document
+    with open(DATA_FILE_PATH, "rb") as f:
+        for item in ijson.items(f, "assessments.item", use_float=True):
+            raw_count += 1
+            record = _filter_record(item)
+            if record is not None:
+                valid_data.append(record)
+    
+    print(f"Loaded {raw_count} raw assessments.")
     print(f"Filtered down to {len(valid_data)} valid assessments (Individual Test Solutions).")
     return valid_data
 
 
-def generate_embeddings(texts: List[str]) -> List[List[float]]:
-    """Generate embeddings using sentence-transformers"""
+def _filter_record(item: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Build the ingestion record for one raw assessment, or None if it is filtered out"""
+    # Filter logic
+    # Requirement: Filter out "Pre-packaged Job Solutions"
+    # The file has a "type" field
+    atype = item.get("type", "")
+    if "Pre-packaged" in atype or "Job Solution" in atype:
+        if atype != "Individual Test Solution":  # Keep Individual Test Solutions
+            return None
+            
+    # Also check name/categorization if type is ambiguous
+    if item.get("job_family") == "Pre-packaged Job Solutions":
+         return None
+
+    # Extract Fields
+    name = item.get("name", "")
+    
+    # INFER JOB LEVEL
+    name_lower = name.lower()
+    job_level = "General"
+    if any(x in name_lower for x in _ENTRY_KWS):
+        job_level = "Entry_Level"
+    elif any(x in name_lower for x in _SENIOR_KWS):
+        job_level = "Manager_Senior"
+        
+    description = item.get("description", "")
+    url_id = item.get('id', '').replace('_', '-')
+    url = f"https://www.shl.com/solutions/products/product-catalog/view/{url_id}/"  # Reconstruct URL if missing
+    
+    duration = clean_duration(item.get("duration"))
+    adaptive = "Yes" if item.get("adaptive") else "No"
+    remote = "Yes" if item.get("remote_testing") else "No"
+    
+    test_types = item.get("test_types", [])
+    test_type_str = test_types[0] if test_types else "General"
+    
+    # Create full text for embedding
+    # Title + Description + Keywords
+    full_text = f"{name}. {description}. {test_type_str}"
+    
+    record = {
+        "name": name,
+        "url": url,
+        "description": description,
+        "duration": duration,
+        "adaptive_support": adaptive,
+        "remote_support": remote,
+        "test_type": test_type_str, 
+        "test_types": test_types or [test_type_str],
+        "full_text": full_text,
+        "job_level": job_level
+    }
+    return record
+
+
+def load_embedding_model():
+    """Load the sentence-transformers model on the best available device"""
+    import torch
     from sentence_transformers import SentenceTransformer
     
-    print(f"Loading embedding model: {EMBEDDING_MODEL}")
-    model = SentenceTransformer(EMBEDDING_MODEL)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    print(f"Loading embedding model: {EMBEDDING_MODEL} ({device})")
+    model = SentenceTransformer(EMBEDDING_MODEL, device=device)
+    if device == "cuda":
+        model.half()  # FP16 weights/activations on GPU
+    return model
+
+
+def encode_texts(model, texts: List[str], show_progress_bar: bool = True) -> np.ndarray:
+    """Encode texts with an already-loaded model into an (N, dim) float32 array"""
+    # Encode each distinct text once and broadcast back (stable first-seen order)
+    unique_index: Dict[str, int] = {}
+    inverse = np.array([unique_index.setdefault(t, len(unique_index)) for t in texts], dtype=np.intp)
+    unique_texts = list(unique_index)
+    if show_progress_bar:
+        print(f"Dedup: {len(unique_texts)}/{len(texts)} unique")
     
-    print("Generating embeddings...")
-    embeddings = model.encode(texts, normalize_embeddings=True, show_progress_bar=True)
+    unique_embeddings = model.encode(
+        unique_texts,
+        batch_size=256 if model.device.type == "cuda" else 128,  # Amortize per-batch overhead
+        normalize_embeddings=True,
+        convert_to_numpy=True,
+        show_progress_bar=show_progress_bar
+    ).astype(np.float32, copy=False)  # FP16 output on GPU; stores expect float32
+    return unique_embeddings[inverse]
+
+
+def generate_embeddings(texts: List[str]) -> np.ndarray:
+    """Generate embeddings using sentence-transformers"""
+    model = load_embedding_model()
     
-    return embeddings.tolist()
+    print("Generating embeddings...")
+    # Stay an (N, dim) ndarray; callers convert one batch at a time
+    return encode_texts(model, texts)
 
 
 def ingest_to_chromadb(data: List[Dict[str, Any]]):
     """Ingest data to ChromaDB"""
-    import chromadb
-    
     print("\n" + "=" * 80)
     print("Ingesting to ChromaDB")
     print("=" * 80)
     
-    CHROMA_DB_DIR = "backend/data/chromadb"
-    db_path = BASE_DIR / CHROMA_DB_DIR
+    sys.path.append(str(BACKEND_DIR))
+    from app.core.vector_db import chroma_client, chroma_collection_metadata, chroma_persist_path
+    
+    # Same persistent store the API's ChromaDB backend reads, so restarts never re-index
+    db_path = chroma_persist_path()
     os.makedirs(db_path, exist_ok=True)
     
     print(f"Initializing ChromaDB in {db_path}")
-    client = chromadb.PersistentClient(path=str(db_path))
+    client = chroma_client()
     
-    # Reset collection
-    try:
-        client.delete_collection(COLLECTION_NAME)
-        print("Deleted existing collection")
-    except:
-        pass
-        
-    collection = client.create_collection(
+    # Upserts make re-runs idempotent, so the collection is reused rather than dropped -
+    # unless its HNSW parameters are stale (they are fixed at creation)
+    collection_metadata = chroma_collection_metadata()
+    collection = client.get_or_create_collection(
         name=COLLECTION_NAME,
-        metadata={"hnsw:space": "cosine"}
+        metadata=collection_metadata
     )
+    if collection.metadata != collection_metadata:
+        print(f"Recreating collection with HNSW settings {collection_metadata}")
+        client.delete_collection(COLLECTION_NAME)
+        collection = client.create_collection(name=COLLECTION_NAME, metadata=collection_metadata)
     
-    # Generate embeddings
-    texts = [item["full_text"] for item in data]
-    embeddings = generate_embeddings(texts)
-    
-    # Insert in batches
-    batch_size = 32
     total = len(data)
+    all_ids = [str(i) for i in range(total)]
+    documents = [item["full_text"] for item in data]
+    metadatas = [{
+        "name": item["name"],
+        "url": item["url"],
+        "duration": item["duration"],
+        "adaptive_support": item["adaptive_support"],
+        "remote_support": item["remote_support"],
+        "test_type": item["test_type"],
+        # Every test type, so results are built from metadata alone (JSON: metadata values are scalars)
+        "test_types": orjson.dumps(item["test_types"]).decode("utf-8"),
+        "job_level": item["job_level"],
+        "description": item["description"][:1000]
+    } for item in data]
     
-    print("Inserting into ChromaDB...")
-    for i in tqdm(range(0, total, batch_size)):
-        batch = data[i:i+batch_size]
-        batch_embeddings = embeddings[i:i+batch_size]
+    # Incremental re-index: only rows whose document or metadata changed since
+    # the last run are re-embedded and written
+    existing = collection.get(ids=all_ids, include=["documents", "metadatas"])
+    stored = {
+        record_id: (document, metadata)
+        for record_id, document, metadata in zip(existing["ids"], existing["documents"], existing["metadatas"])
+    }
+    if FORCE_REINDEX:
+        # Schema/model changes: re-embed everything
+        changed = list(range(total))
+    else:
+        changed = [i for i in range(total) if stored.get(all_ids[i]) != (documents[i], metadatas[i])]
+    print(f"{len(changed)}/{total} items new or changed")
+    
+    if changed:
+        model = load_embedding_model()
         
-        documents = [item["full_text"] for item in batch]
-        ids = [str(i + idx) for idx, _ in enumerate(batch)]
-        metadatas = [{
-            "name": item["name"],
-            "url": item["url"],
-            "duration": item["duration"],
-            "adaptive_support": item["adaptive_support"],
-            "remote_support": item["remote_support"],
-            "test_type": item["test_type"],
-            "job_level": item["job_level"],
-            "description": item["description"][:1000]
-        } for item in batch]
+        # Encode and insert in large batches, within the client's maximum. Each batch is
+        # upserted on a writer thread while the next one is encoded, so HNSW insertion
+        # overlaps encoding and only ~two batches of embeddings are held at once
+        batch_size = min(1000, client.get_max_batch_size())
+        batches = [changed[start:start+batch_size] for start in range(0, len(changed), batch_size)]
         
-        collection.add(
-            ids=ids,
-            embeddings=batch_embeddings,
-            metadatas=metadatas,
-            documents=documents
-        )
+        print("Embedding and inserting into ChromaDB...")
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            pending = None
+            for batch in tqdm(batches):
+                embeddings = encode_texts(model, [documents[i] for i in batch], show_progress_bar=False)
+                if pending is not None:
+                    pending.result()  # Surface write errors; keeps at most one write in flight
+                pending = writer.submit(
+                    collection.upsert,
+                    ids=[all_ids[i] for i in batch],
+                    # Contiguous float32 array, no list conversion. Chroma stores float32
+                    # internally, so a float16 cast here would only lose precision
+                    embeddings=embeddings,
+                    metadatas=[metadatas[i] for i in batch],
+                    documents=[documents[i] for i in batch]
+                )
+            if pending is not None:
+                pending.result()
+    
+    # Drop entries left over from a previous, larger run
+    stale_ids = set(collection.get(include=[])["ids"]).difference(all_ids)
+    if stale_ids:
+        collection.delete(ids=list(stale_ids))
+        print(f"Removed {len(stale_ids)} stale items")
         
     print(f"✅ Successfully indexed {total} items into ChromaDB.")
 
 
 def ingest_to_supabase(data: List[Dict[str, Any]]):
     """Ingest data to Supabase"""
-    sys.path.append(str(BASE_DIR / "backend"))
+    sys.path.append(str(BACKEND_DIR))
     from app.core.database import get_supabase_client
     
     print("\n" + "=" * 80)
@@ -227,42 +305,130 @@ def ingest_to_supabase(data: List[Dict[str, Any]]):
     texts = [item["full_text"] for item in data]
     embeddings = generate_embeddings(texts)
     
-    # Insert in batches
+    # Insert in batches, several in flight at once (network RTT dominates)
     batch_size = 100
     total = len(data)
+    
+    inserted = None
+    pg_dsn = os.getenv("SUPABASE_PG_DSN")
+    if pg_dsn:
+        # Direct Postgres COPY is much faster than REST upserts for vector rows
+        try:
+            print("Copying into Supabase Postgres...")
+            inserted = _copy_supabase_rows(pg_dsn, data, embeddings)
+        except Exception as e:
+            print(f"⚠️ COPY ingestion failed, falling back to REST: {e}")
+    
+    if inserted is None:
+        print("Inserting into Supabase...")
+        inserted = asyncio.run(_upload_supabase_batches(data, embeddings, batch_size))
+    
+    print(f"✅ Successfully indexed {inserted}/{total} items into Supabase.")
+
+
+_COPY_COLUMNS = (
+    "id", "name", "url", "description", "duration", "adaptive_support",
+    "remote_support", "test_type", "job_level", "full_text", "embedding"
+)
+
+
+def _copy_supabase_rows(dsn: str, data: List[Dict[str, Any]], embeddings: np.ndarray) -> int:
+    """Upsert all rows in one transaction: COPY into a temp table, then merge on id"""
+    import psycopg
+    
+    columns = ", ".join(_COPY_COLUMNS)
+    updates = ", ".join(f"{c} = EXCLUDED.{c}" for c in _COPY_COLUMNS[1:])
+    
+    with psycopg.connect(dsn) as conn, conn.cursor() as cur:
+        cur.execute(
+            "CREATE TEMP TABLE _ingest_embeddings "
+            "(LIKE assessment_embeddings INCLUDING DEFAULTS) ON COMMIT DROP"
+        )
+        with cur.copy(f"COPY _ingest_embeddings ({columns}) FROM STDIN") as copy:
+            for i, item in enumerate(tqdm(data)):
+                copy.write_row((
+                    str(i),
+                    item['name'],
+                    item['url'],
+                    item['description'],
+                    item['duration'],
+                    item['adaptive_support'],
+                    item['remote_support'],
+                    item['test_type'],
+                    item['job_level'],
+                    item['full_text'],
+                    "[" + ",".join(map(str, embeddings[i].tolist())) + "]"  # pgvector text form
+                ))
+        cur.execute(
+            f"INSERT INTO assessment_embeddings ({columns}) "
+            f"SELECT {columns} FROM _ingest_embeddings "
+            f"ON CONFLICT (id) DO UPDATE SET {updates}"
+        )
+        return cur.rowcount
+
+
+async def _upload_supabase_batches(
+    data: List[Dict[str, Any]],
+    embeddings: np.ndarray,
+    batch_size: int,
+    max_concurrency: int = 8
+) -> int:
+    """Upsert record batches through the PostgREST endpoint, at most max_concurrency at a time"""
+    import httpx
+    from app.core.config import get_settings
+    
+    settings = get_settings()
+    url = f"{settings.supabase_url}/rest/v1/assessment_embeddings"
+    headers = {
+        "apikey": settings.supabase_key,
+        "Authorization": f"Bearer {settings.supabase_key}",
+        "Content-Type": "application/json",
+        "Prefer": "resolution=merge-duplicates,return=minimal"  # Upsert on primary key
+    }
+    semaphore = asyncio.Semaphore(max_concurrency)
     inserted = 0
     
-    print("Inserting into Supabase...")
-    for i in tqdm(range(0, total, batch_size)):
+    async def upload_batch(client: httpx.AsyncClient, progress: tqdm, i: int):
+        nonlocal inserted
         batch = data[i:i+batch_size]
         batch_embeddings = embeddings[i:i+batch_size]
         
         # Prepare Supabase records
-        supabase_records = []
-        for idx, item in enumerate(batch):
-            record = {
-                'id': str(i + idx),
-                'name': item['name'],
-                'url': item['url'],
-                'description': item['description'],
-                'duration': item['duration'],
-                'adaptive_support': item['adaptive_support'],
-                'remote_support': item['remote_support'],
-                'test_type': item['test_type'],
-                'job_level': item['job_level'],
-                'full_text': item['full_text'],
-                'embedding': batch_embeddings[idx]
-            }
-            supabase_records.append(record)
+        supabase_records = [{
+            'id': str(i + idx),
+            'name': item['name'],
+            'url': item['url'],
+            'description': item['description'],
+            'duration': item['duration'],
+            'adaptive_support': item['adaptive_support'],
+            'remote_support': item['remote_support'],
+            'test_type': item['test_type'],
+            'job_level': item['job_level'],
+            'full_text': item['full_text'],
+            'embedding': embedding  # Serialized directly by orjson
+        } for idx, (item, embedding) in enumerate(zip(batch, batch_embeddings))]
         
         # Insert batch
-        try:
-            result = db.table("assessment_embeddings").upsert(supabase_records).execute()
-            inserted += len(batch)
-        except Exception as e:
-            print(f"\n❌ Batch {i//batch_size + 1} failed: {e}")
+        async with semaphore:
+            try:
+                response = await client.post(
+                    url,
+                    headers=headers,
+                    content=orjson.dumps(supabase_records, option=orjson.OPT_SERIALIZE_NUMPY)
+                )
+                response.raise_for_status()
+                inserted += len(batch)
+            except Exception as e:
+                print(f"\n❌ Batch {i//batch_size + 1} failed: {e}")
+        progress.update(len(batch))
     
-    print(f"✅ Successfully indexed {inserted}/{total} items into Supabase.")
+    async with httpx.AsyncClient(timeout=60.0) as client:
+        with tqdm(total=len(data)) as progress:
+            await asyncio.gather(*(
+                upload_batch(client, progress, i) for i in range(0, len(data), batch_size)
+            ))
+    
+    return inserted
 
 
 def ingest():
@@ -1,14 +1,90 @@
 """
 NLP-based recommendation engine using TF-IDF and advanced text matching
 """
-from typing import List, Dict
+import asyncio
+from typing import List, Dict, Optional, Tuple
+from functools import lru_cache
+from pathlib import Path
+import hashlib
+import joblib
 import numpy as np
+from sklearn.base import clone
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 
 from app.models.schemas import RecommendationRequest, RecommendationItem, RecommendationScore, AssessmentResponse
+from app.core.cache import EmbeddingCache
 from app.core.logging import log
 
+# Fitted (vectorizer, tfidf_matrix, assessments) snapshots, keyed by corpus hash
+NLP_CACHE_DIR = Path(__file__).resolve().parents[2] / "data" / "nlp_cache"
+# Bump whenever the assessment document text changes so older snapshots are not reused
+NLP_DOCUMENT_VERSION = 2
+
+
+def _list_field(assessment: dict, key: str) -> Tuple[str, ...]:
+    """Array column as a (hashable) tuple; anything that isn't a list counts as empty"""
+    value = assessment.get(key)
+    return tuple(value) if isinstance(value, list) else ()
+
+
+@lru_cache(maxsize=4096)
+def _assessment_document(
+    name: str,
+    type_: str,
+    job_family: str,
+    job_level: str,
+    description: str,
+    test_types: Tuple[str, ...],
+    skills: Tuple[str, ...],
+    industries: Tuple[str, ...]
+) -> str:
+    """Assessment document text, memoized on its source fields so re-fits skip rebuilding"""
+    parts = [name, type_, job_family, job_level, description]
+    
+    # Add test types
+    parts.extend(test_types)
+    
+    # Add skills with higher weight
+    parts.extend(skills * 2)  # Weight skills more
+    
+    # Add industries
+    parts.extend(industries)
+    
+    return " ".join(parts)
+
+
+@lru_cache(maxsize=2048)
+def _query_document(
+    job_title: Optional[str],
+    job_family: Optional[str],
+    job_level: Optional[str],
+    industry: Optional[str],
+    required_skills: Tuple[str, ...],
+    test_types: Tuple[str, ...]
+) -> str:
+    """Query document text, memoized on the (hashable) request fields it is built from"""
+    parts = []
+    
+    if job_title:
+        parts.append(job_title * 2)  # Weight job title
+    
+    if job_family:
+        parts.append(job_family)
+    
+    if job_level:
+        parts.append(job_level)
+    
+    if industry:
+        parts.append(industry)
+    
+    if required_skills:
+        parts.extend(required_skills * 2)  # Weight skills
+    
+    if test_types:
+        parts.extend(test_types)
+    
+    return " ".join(parts) if parts else "general assessment"
+
 
 class NLPRecommender:
     """
@@ -23,32 +99,38 @@ class NLPRecommender:
             ngram_range=(1, 3),
             max_features=1000,
             min_df=1,
-            max_df=0.95
+            max_df=0.95,
+            dtype=np.float32  # Halves matrix/query memory; ranking is not precision-limited
         )
         self.tfidf_matrix = None
+        self.tfidf_matrix_t = None  # CSR transpose for query @ matrix products
         self.assessments_cache = []
+        
+        # Persistent query-vector cache; keys include the fitted vocabulary/idf signature
+        self.query_cache = EmbeddingCache()
+        self._vectorizer_sig = b""
+        # Similarities for a request with no text signal, computed once per fit
+        self._default_similarities = None
+        
+        # Filter attributes as arrays aligned with assessments_cache (0 = unknown duration)
+        self._remote = np.zeros(0, dtype=bool)
+        self._duration = np.zeros(0, dtype=np.int32)
+        # AssessmentResponse per assessments_cache index, built on first use and reset on (re)fit
+        self._response_cache: List[Optional[AssessmentResponse]] = []
+        self._fit_lock = asyncio.Lock()  # Serializes the lazy cold-start fit
     
     def _create_assessment_document(self, assessment: dict) -> str:
         """Create document representation"""
-        parts = [
+        return _assessment_document(
             assessment.get('name', ''),
             assessment.get('type', ''),
             assessment.get('job_family', '') or "",
             assessment.get('job_level', '') or "",
-            assessment.get('description', '') or ""
-        ]
-        
-        # Add test types
-        parts.extend([])
-        
-        # Add skills with higher weight
-        skills = []
-        parts.extend(skills * 2)  # Weight skills more
-        
-        # Add industries
-        parts.extend([])
-        
-        return " ".join(parts)
+            assessment.get('description', '') or "",
+            _list_field(assessment, 'test_types'),
+            _list_field(assessment, 'skills'),
+            _list_field(assessment, 'industries')
+        )
     
     def fit(self, db):
         """Fit the vectorizer on all assessments"""
@@ -56,42 +138,94 @@ class NLPRecommender:
         
         response = db.table("assessments").select("*").execute()
         assessments = response.data
-        self.assessments_cache = assessments
         
         if not assessments:
+            self.assessments_cache = []
             log.warning("No assessments found")
             return
         
+        # Reuse a previous fit of the same corpus (ids + updated_at), document format and vectorizer settings from disk
+        corpus_hash = hashlib.blake2b(
+            f"{NLP_DOCUMENT_VERSION}\x00".encode("utf-8")
+            + repr(sorted(self.vectorizer.get_params().items())).encode("utf-8")
+            + b"".join(f"{a.get('id', '')}\x00{a.get('updated_at', '')}\x00".encode("utf-8") for a in assessments),
+            digest_size=16
+        ).hexdigest()
+        cache_path = NLP_CACHE_DIR / f"{corpus_hash}.joblib"
+        if cache_path.exists():
+            try:
+                self._publish(*joblib.load(cache_path))
+                log.info(f"NLP recommender loaded from cache ({len(self.assessments_cache)} assessments)")
+                return
+            except Exception as e:
+                log.warning(f"Failed to load NLP cache, refitting: {e}")
+        
         # Create documents
         documents = [self._create_assessment_document(a) for a in assessments]
         
-        # Fit and transform
-        self.tfidf_matrix = self.vectorizer.fit_transform(documents)
+        # Fit and transform on a fresh copy; nothing is visible until _publish
+        vectorizer = clone(self.vectorizer)
+        tfidf_matrix = vectorizer.fit_transform(documents)
+        self._publish(vectorizer, tfidf_matrix, assessments)
         log.info(f"NLP recommender fitted on {len(assessments)} assessments")
-    
-    def _create_query_document(self, request: RecommendationRequest) -> str:
-        """Create query document"""
-        parts = []
-        
-        if request.job_title:
-            parts.append(request.job_title * 2)  # Weight job title
-        
-        if request.job_family:
-            parts.append(request.job_family)
-        
-        if request.job_level:
-            parts.append(request.job_level)
-        
-        if request.industry:
-            parts.append(request.industry)
         
-        if request.required_skills:
-            parts.extend(request.required_skills * 2)  # Weight skills
+        try:
+            NLP_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            # Matrix stays scipy-sparse inside the pickle
+            joblib.dump((vectorizer, tfidf_matrix, assessments), cache_path, compress=3)
+        except Exception as e:
+            log.warning(f"Failed to write NLP cache: {e}")
+    
+    def _publish(self, vectorizer: TfidfVectorizer, tfidf_matrix, assessments: List[dict]):
+        """Install a fitted model and its derived state, tfidf_matrix last
         
-        if request.test_types:
-            parts.extend([tt.value if hasattr(tt, 'value') else tt for tt in request.test_types])
+        recommend reads tfidf_matrix without the fit lock to decide whether a
+        fit is needed, so it must only become non-None once everything it
+        depends on is in place.
+        """
+        self.vectorizer = vectorizer
+        self.assessments_cache = assessments
+        self.tfidf_matrix_t = tfidf_matrix.T.tocsr()
+        self._vectorizer_sig = self._compute_vectorizer_sig()
+        self._default_similarities = None
+        self._build_filter_columns()
+        self.tfidf_matrix = tfidf_matrix
+    
+    def _build_filter_columns(self):
+        """Materialize the per-assessment filter attributes as NumPy columns"""
+        assessments = self.assessments_cache
+        self._remote = np.array([bool(a.get('remote_testing', False)) for a in assessments], dtype=bool)
+        self._duration = np.array([a.get('duration') or 0 for a in assessments], dtype=np.int32)
         
-        return " ".join(parts) if parts else "general assessment"
+        self._response_cache = [None] * len(assessments)
+    
+    def _compute_vectorizer_sig(self) -> bytes:
+        """Hash of the fitted vocabulary and idf weights (changes on every refit that matters)"""
+        h = hashlib.blake2b(digest_size=16)
+        for term, index in sorted(self.vectorizer.vocabulary_.items()):
+            h.update(f"{term}\x00{index}\x00".encode("utf-8"))
+        h.update(self.vectorizer.idf_.tobytes())
+        return h.digest()
+    
+    def _transform_query(self, query_doc: str):
+        """TF-IDF query vector, served from the persistent cache when possible"""
+        key = hashlib.blake2b(self._vectorizer_sig + query_doc.encode("utf-8"), digest_size=16).digest()
+        query_vector = self.query_cache.get(key)
+        if query_vector is None:
+            query_vector = self.vectorizer.transform([query_doc])
+            self.query_cache.put(key, query_vector)
+        return query_vector
+    
+    def _create_query_document(self, request: RecommendationRequest) -> str:
+        """Create query document"""
+        return _query_document(
+            request.job_title,
+            request.job_family,
+            request.job_level,
+            request.industry,
+            tuple(request.required_skills or ()),
+            tuple(getattr(tt, 'value', tt) for tt in request.test_types or ())
+        )
     
     async def recommend(
         self, 
@@ -101,46 +235,59 @@ class NLPRecommender:
         """
         Generate recommendations using NLP
         """
-        log.info(f"NLP recommendation for: {request.dict()}")
+        log.opt(lazy=True).debug("NLP recommendation for: {}", lambda: request.model_dump())
         
         if self.tfidf_matrix is None:
-            self.fit(db)
-        
-        # Create query vector
-        query_doc = self._create_query_document(request)
-        query_vector = self.vectorizer.transform([query_doc])
+            # Fit (DB fetch + TF-IDF) in a worker thread so the event loop keeps serving
+            async with self._fit_lock:
+                if self.tfidf_matrix is None:
+                    await asyncio.to_thread(self.fit, db)
         
-        # Calculate similarities
-        similarities = cosine_similarity(query_vector, self.tfidf_matrix)[0]
+        # Language is request-level: only English assessments are stored
+        if request.language and request.language not in ['English']:
+            log.info(f"NLP returned 0 recommendations (language {request.language} unavailable)")
+            return []
         
-        # Get top indices
-        top_indices = np.argsort(similarities)[::-1]
+        has_signal = any([
+            request.job_title, request.job_family, request.job_level,
+            request.industry, request.required_skills, request.test_types
+        ])
+        if not has_signal and self._default_similarities is not None:
+            # Every such request maps to the same default query document
+            similarities = self._default_similarities
+        else:
+            # Create query vector
+            query_doc = self._create_query_document(request)
+            query_vector = self._transform_query(query_doc)
+            
+            # Calculate similarities - TF-IDF rows are already L2-normalized, so
+            # cosine similarity is a plain sparse dot product
+            similarities = (query_vector @ self.tfidf_matrix_t).toarray().ravel()
+            if not has_signal:
+                self._default_similarities = similarities
         
         recommendations = []
         
+        # Apply filters as boolean masks (skip very low similarity scores too)
+        mask = similarities >= 0.01
+        if request.remote_testing_required:
+            mask &= self._remote
+        if request.max_duration:
+            mask &= (self._duration == 0) | (self._duration <= request.max_duration)
+        
+        # Top-K of the surviving candidates only
+        candidates = np.flatnonzero(mask)
+        k = min(request.num_recommendations, len(candidates))
+        if k == 0:
+            log.info("NLP returned 0 recommendations")
+            return recommendations
+        top_indices = candidates[np.argpartition(-similarities[candidates], k - 1)[:k]]
+        top_indices = top_indices[np.argsort(-similarities[top_indices])]
+        
         for idx in top_indices:
-            if len(recommendations) >= request.num_recommendations:
-                break
-            
             assessment = self.assessments_cache[idx]
             similarity = float(similarities[idx])
             
-            # Apply filters
-            if request.remote_testing_required and not assessment.get('remote_testing', False):
-                continue
-            
-            if request.max_duration and assessment.get('duration') and assessment.get('duration', 0) > request.max_duration:
-                continue
-            
-            if request.language:
-                languages = ['English']
-                if request.language not in languages:
-                    continue
-            
-            # Skip very low similarity scores
-            if similarity < 0.01:
-                continue
-            
             # Calculate additional scores
             skill_match = self._calculate_skill_match(request, assessment)
             industry_match = self._calculate_industry_match(request, assessment)
@@ -148,7 +295,7 @@ class NLPRecommender:
             # Combined score
             total_score = (similarity * 0.5) + (skill_match * 0.3) + (industry_match * 0.2)
             
-            assessment_response = self._db_to_response(assessment)
+            assessment_response = self._response_for(idx)
             
             score = RecommendationScore(
                 total_score=total_score,
@@ -172,7 +319,7 @@ class NLPRecommender:
         if not request.required_skills:
             return 0.5
         
-        assessment_skills = set()
+        assessment_skills = set(s.lower() for s in _list_field(assessment, 'skills'))
         required_skills = set(s.lower() for s in request.required_skills)
         
         if not assessment_skills:
@@ -186,7 +333,7 @@ class NLPRecommender:
         if not request.industry:
             return 0.5
         
-        assessment_industries = []
+        assessment_industries = [i.lower() for i in _list_field(assessment, 'industries')]
         
         if "all industries" in assessment_industries:
             return 1.0
@@ -196,6 +343,14 @@ class NLPRecommender:
         
         return 0.0
     
+    def _response_for(self, idx: int) -> AssessmentResponse:
+        """Response schema for assessments_cache[idx], validated once per fit"""
+        response = self._response_cache[idx]
+        if response is None:
+            response = self._db_to_response(self.assessments_cache[idx])
+            self._response_cache[idx] = response
+        return response
+    
     def _db_to_response(self, assessment: dict) -> AssessmentResponse:
         """Convert database model to response schema"""
         return AssessmentResponse(
@@ -3,10 +3,12 @@ Updated RAG Recommender with Supabase pgvector Support
 Supports both ChromaDB (local) and Supabase (production)
 """
 import logging
-from typing import List, Dict, Any, Optional
+from functools import lru_cache
+from typing import List, Dict, Any, Optional, Tuple
 from pathlib import Path
 from app.services.embedding_service import HuggingFaceEmbeddingService
 from app.core.vector_db import get_vector_db
+from app.core.config import get_settings
 # CrossEncoder imported conditionally in __init__ for development only
 import os
 import google.generativeai as genai
@@ -15,9 +17,47 @@ import numpy as np
 from rank_bm25 import BM25Okapi
 from collections import defaultdict
 import requests
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from cachetools import TTLCache
 
 log = logging.getLogger(__name__)
 
+# Final recommendation lists keyed by normalized query text - hot queries skip
+# Gemini expansion, embedding, vector search and reranking entirely. Entries
+# expire with the vector table snapshot (vector_table_cache_ttl, 0 = no caching)
+_recommendation_cache_ttl = get_settings().vector_table_cache_ttl
+_recommendation_cache: TTLCache = TTLCache(maxsize=512, ttl=_recommendation_cache_ttl)
+_recommendation_cache_lock = threading.Lock()
+
+
+# In-flight or finished local CrossEncoder loads by model name. A load that
+# outlives the startup timeout keeps running; later attempts reuse its future
+# instead of starting a second load.
+_reranker_loads: Dict[str, Future] = {}
+_reranker_loads_lock = threading.Lock()
+
+
+def _local_reranker_load(model_name: str) -> Future:
+    """Future for the local CrossEncoder, starting the load only if none is pending or done"""
+    with _reranker_loads_lock:
+        future = _reranker_loads.get(model_name)
+        if future is None or (future.done() and future.exception() is not None):
+            from sentence_transformers import CrossEncoder
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="reranker-load")
+            future = executor.submit(CrossEncoder, model_name)
+            executor.shutdown(wait=False)  # The worker exits once the load finishes
+            _reranker_loads[model_name] = future
+        return future
+
+
+def _copy_results(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Per-caller copies of cached result dicts (including their test_type lists)"""
+    return [
+        {k: list(v) if isinstance(v, list) else v for k, v in r.items()}
+        for r in results
+    ]
+
 class RAGRecommender:
     """
     RAG-based recommendation engine with hybrid backend support.
@@ -82,6 +122,7 @@ class RAGRecommender:
         # CRITICAL: Never load local CrossEncoder in production (causes OOM on Render)
         # Only use remote API or skip reranking
         environment = os.getenv("ENVIRONMENT", "development")
+        self._reranker_load: Optional[Future] = None  # Local load still running after the timeout
         
         if self.reranker_api_url:
             log.info(f"Using Remote Reranker API: {self.reranker_api_url}")
@@ -91,12 +132,18 @@ class RAGRecommender:
             log.warning("No RERANKER_API_URL in production. Reranking disabled to prevent OOM.")
             self.reranker = None
         else:
+            # Only load local model in development, bounded by the model loading timeout.
+            # Thread-based so it works off the main thread (startup runs in a worker thread)
+            timeout = get_settings().model_loading_timeout
             try:
-                # Only load local model in development
                 log.info("Development mode: Loading local CrossEncoder...")
-                from sentence_transformers import CrossEncoder
-                self.reranker = CrossEncoder(model_name)
+                future = _local_reranker_load(model_name)
+                self.reranker = future.result(timeout=timeout)
                 log.info(f"Loaded Local Reranker: {model_name}")
+            except FuturesTimeoutError:
+                log.error(f"Reranker load timed out after {timeout}s. Reranking disabled until it finishes.")
+                self.reranker = None
+                self._reranker_load = future
             except Exception as e:
                 log.error(f"Failed to load Reranker: {e}")
                 self.reranker = None
@@ -106,13 +153,34 @@ class RAGRecommender:
         self.bm25_docs = []
         self.bm25_metas = []
         self._bm25_initialized = False
+        self._bm25_lock = threading.Lock()  # One build even if warmup and a request race
         log.info("BM25 index will be lazy-loaded on first use")
     
+    def warmup(self):
+        """Build the lazily-loaded indexes now, off the request path (called at startup)"""
+        if self.vector_db:
+            self._ensure_bm25_initialized()
+        
+        # Embed common queries up front: wakes a cold embedding backend and seeds the
+        # query-embedding LRU, so those queries skip the HF round trip when they arrive
+        warmup_queries = [q[:1000] for q in get_settings().rag_warmup_queries if q]
+        if warmup_queries:
+            try:
+                self.embedding_service.encode(warmup_queries, is_query=True, batch_size=64)
+                log.info(f"Pre-computed {len(warmup_queries)} warmup query embeddings")
+            except Exception as e:
+                log.warning(f"Warmup query embedding failed: {e}")
+    
     def _ensure_bm25_initialized(self):
         """Lazy-load BM25 index on first use"""
         if self._bm25_initialized:
             return
-            
+        with self._bm25_lock:
+            if not self._bm25_initialized:
+                self._build_bm25()
+    
+    def _build_bm25(self):
+        """Fetch all documents from the vector DB and build the BM25 index"""
         try:
             # Get all documents from vector DB
             metadatas, documents = self.vector_db.get_all()
@@ -134,8 +202,12 @@ class RAGRecommender:
 
     def extract_metadata_constraints(self, user_query: str) -> Dict[str, Any]:
         """Extract metadata constraints from query using Gemini"""
+        return self._extract_metadata_constraints(user_query)[0]
+    
+    def _extract_metadata_constraints(self, user_query: str) -> Tuple[Dict[str, Any], bool]:
+        """Constraints plus whether the Gemini call succeeded (False = empty fallback)"""
         if not self.gemini_model:
-            return {}
+            return {}, True
         
         try:
             prompt = (
@@ -164,22 +236,26 @@ class RAGRecommender:
                 json_str = text[json_start:json_end]
                 constraints = json.loads(json_str)
                 log.info(f"Extracted constraints: {constraints}")
-                return constraints
-            return {}
+                return constraints, True
+            return {}, True
         except Exception as e:
             log.error(f"Metadata extraction failed: {e}")
-            return {}
+            return {}, False
     
     def multi_expand_query(self, user_query: str) -> List[str]:
         """
         Generates multiple diverse search queries for better coverage.
         Returns: [original_query, skills_query, roles_query, domain_query]
         """
+        return self._multi_expand_query(user_query)[0]
+    
+    def _multi_expand_query(self, user_query: str) -> Tuple[List[str], bool]:
+        """Query variants plus whether Gemini expansion succeeded (False = original-query fallback)"""
         # ALWAYS include the original query first for exact matching
         queries = [user_query]
         
         if not self.gemini_model:
-            return queries
+            return queries, True
             
         try:
             prompt = (
@@ -204,34 +280,59 @@ class RAGRecommender:
                     expanded_queries.append(keywords.strip())
             
             # Add expanded queries to the list
-            if len(expanded_queries) >= 3:
+            expanded = len(expanded_queries) >= 3
+            if expanded:
                 queries.extend(expanded_queries[:3])
             else:
                 # Fallback: duplicate original query
                 queries.extend([user_query] * 3)
             
             log.info(f"Multi-Query Expansion: {len(queries)} variants (original + {len(queries)-1} expanded)")
-            return queries[:4]  # Return original + 3 expanded = 4 total
+            return queries[:4], expanded  # Return original + 3 expanded = 4 total
             
         except Exception as e:
             log.error(f"Multi-Query Expansion failed: {e}")
-            return queries  # Return at least the original query
+            return queries, False  # Return at least the original query
 
     def recommend(self, query: str, n_results: int = 10) -> List[Dict[str, Any]]:
         """
         Hybrid Retrieval: Multi-Query + BM25 + Semantic + Metadata Filtering + Reranking
         """
+        cache_key = (" ".join(query.lower().split()), n_results)
+        with _recommendation_cache_lock:
+            cached = _recommendation_cache.get(cache_key)
+        if cached is not None:
+            log.info("RAG cache hit - skipping retrieval")
+            return _copy_results(cached)
+        
+        recommendations, full_pipeline = self._recommend_uncached(query, n_results)
+        # Empty lists are also what failures return, and degraded answers would
+        # outlive the fault that caused them, so neither is cached
+        if recommendations and full_pipeline and _recommendation_cache_ttl > 0:
+            with _recommendation_cache_lock:
+                _recommendation_cache[cache_key] = _copy_results(recommendations)
+        return recommendations
+    
+    def _recommend_uncached(self, query: str, n_results: int) -> Tuple[List[Dict[str, Any]], bool]:
+        """
+        Run the full retrieval pipeline for one query.
+        
+        Also returns whether every stage ran as configured: False when a
+        Gemini call fell back, the reranker was still loading or the remote
+        reranker failed.
+        """
         try:
             # Safety check: if vector DB failed to initialize, return empty
             if not self.vector_db:
                 log.error("Vector DB not initialized. Cannot provide recommendations.")
-                return []
+                return [], False
             
             # 0. Extract Metadata Constraints
-            constraints = self.extract_metadata_constraints(query)
+            constraints, constraints_ok = self._extract_metadata_constraints(query)
             
             # 1. Multi-Query Expansion
-            search_queries = self.multi_expand_query(query)
+            search_queries, expansion_ok = self._multi_expand_query(query)
+            full_pipeline = constraints_ok and expansion_ok
             
             # 1.5. Exact Name Matching Layer (New)
             # Ensure assessments with names matching query terms are included candidates
@@ -299,41 +400,43 @@ class RAGRecommender:
                 
                 log.info(f"Exact Name Matching candidates: {match_count}")
             
-            # Start Semantic Search loop
-            for idx, search_query in enumerate(search_queries):
-                # Truncate if needed
-                if len(search_query) > 1000:
-                    search_query = search_query[:1000]
-                
-                # A) Semantic Search via Vector DB
-                query_embedding = self.embedding_service.encode(search_query, is_query=True).tolist()
-                
-                # Convert constraints to filter format
-                filters = {}
-                if constraints.get('job_level'):
-                    filters['job_level'] = constraints['job_level']
-                if constraints.get('max_duration_minutes'):
-                    filters['max_duration'] = constraints['max_duration_minutes']
-                if constraints.get('requires_remote'):
-                    filters['remote_support'] = 'Yes'
-                if constraints.get('requires_adaptive'):
-                    filters['adaptive_support'] = 'Yes'
-                
-                sem_metas, sem_docs = self.vector_db.search(
-                    query_embedding=query_embedding,
+            # A) Semantic Search via Vector DB - embed every query variant in one
+            # encode call and search them as one batch (single DB round trip)
+            search_queries = [search_query[:1000] for search_query in search_queries]  # Truncate if needed
+            query_embeddings = self.embedding_service.encode(search_queries, is_query=True)  # float32 ndarray
+            
+            # Convert constraints to filter format
+            filters = {}
+            if constraints.get('job_level'):
+                filters['job_level'] = constraints['job_level']
+            if constraints.get('max_duration_minutes'):
+                filters['max_duration'] = constraints['max_duration_minutes']
+            if constraints.get('requires_remote'):
+                filters['remote_support'] = 'Yes'
+            if constraints.get('requires_adaptive'):
+                filters['adaptive_support'] = 'Yes'
+            
+            semantic_results = self.vector_db.search_many(
+                query_embeddings=query_embeddings,
+                n_results=self.retrieval_k,
+                filters=filters if filters else None
+            )
+            
+            # ✅ Fallback: If no results with job_level filter, retry without it
+            empty = [i for i, (sem_metas, _) in enumerate(semantic_results) if len(sem_metas) == 0]
+            if empty and filters and filters.get('job_level'):
+                log.warning(f"No results with job_level={filters['job_level']} filter. Retrying without job level constraint...")
+                filters_no_level = {k: v for k, v in filters.items() if k != 'job_level'}
+                retried = self.vector_db.search_many(
+                    query_embeddings=query_embeddings[empty],
                     n_results=self.retrieval_k,
-                    filters=filters if filters else None
+                    filters=filters_no_level if filters_no_level else None
                 )
-                
-                # ✅ Fallback: If no results with job_level filter, retry without it
-                if len(sem_metas) == 0 and filters and filters.get('job_level'):
-                    log.warning(f"No results with job_level={filters['job_level']} filter. Retrying without job level constraint...")
-                    filters_no_level = {k: v for k, v in filters.items() if k != 'job_level'}
-                    sem_metas, sem_docs = self.vector_db.search(
-                        query_embedding=query_embedding,
-                        n_results=self.retrieval_k,
-                        filters=filters_no_level if filters_no_level else None
-                    )
+                for i, result in zip(empty, retried):
+                    semantic_results[i] = result
+            
+            for idx, search_query in enumerate(search_queries):
+                sem_metas, sem_docs = semantic_results[idx]
                 
                 # Add semantic results
                 for meta, doc in zip(sem_metas, sem_docs):
@@ -394,7 +497,7 @@ class RAGRecommender:
             
             # Prepare for reranking
             if not all_candidates:
-                return []
+                return [], False
             
             metas = list(all_candidates.values())
             docs = list(all_docs.values())
@@ -404,6 +507,18 @@ class RAGRecommender:
             # 3. Reranking Step with Balanced Keyword Boost
             scores = []
             
+            if self.reranker is None and self._reranker_load is not None and self._reranker_load.done():
+                # Pick up a local load that finished after the startup timeout
+                load, self._reranker_load = self._reranker_load, None
+                if load.exception() is None:
+                    self.reranker = load.result()
+                    log.info("Local Reranker finished loading; reranking enabled")
+                else:
+                    log.error(f"Failed to load Reranker: {load.exception()}")
+            if self.reranker is None and self._reranker_load is not None:
+                # Unreranked until the pending load lands
+                full_pipeline = False
+            
             if self.reranker and docs:
                 rerank_query = query  # Original query
                 
@@ -425,12 +540,15 @@ class RAGRecommender:
                                 log.warning("Remote Reranker returned empty scores")
                                 # Fallback: zero scores
                                 scores = np.zeros(len(docs))
+                                full_pipeline = False
                         else:
                             log.error(f"Remote Reranker API failed: {resp.status_code} {resp.text}")
                             scores = np.zeros(len(docs))
+                            full_pipeline = False
                     except Exception as e:
                         log.error(f"Error calling Remote Reranker: {e}")
                         scores = np.zeros(len(docs))
+                        full_pipeline = False
                         
                 else:
                     # --- LOCAL MODEL PATH ---
@@ -439,69 +557,44 @@ class RAGRecommender:
                 
                 # Apply balanced keyword matching boost
                 query_keywords = set(rerank_query.lower().split())
-                boosted_scores = []
+                scores = np.asarray(scores, dtype=np.float64)
+                candidates = range(len(scores))
                 
-                for idx, score in enumerate(scores):
-                    # Check for keyword overlap in document
-                    doc_text = docs[idx].lower()
-                    doc_keywords = set(doc_text.split())
-                    
-                    # Calculate keyword overlap
-                    overlap = len(query_keywords.intersection(doc_keywords))
-                    overlap_ratio = overlap / len(query_keywords) if query_keywords else 0
-                    
-                    # Moderate boost based on keyword overlap (up to +3.0)
-                    keyword_boost = overlap_ratio * 3.0
-                    
-                    # Strong boost for assessment name matching
-                    assessment_name = metas[idx].get('name', '').lower()
-                    name_keywords = set(assessment_name.split())
-                    name_overlap = len(query_keywords.intersection(name_keywords))
-                    name_overlap_ratio = name_overlap / len(query_keywords) if query_keywords else 0
-                    
-                    # Higher boost for name matches (up to +5.0)
-                    name_boost = name_overlap_ratio * 5.0
-                    
-                    # ✅ Apply job level penalty instead of hard filtering
-                    job_level_penalty = 0
-                    if constraints.get('job_level'):
-                        cand_level = metas[idx].get('job_level', 'General')
-                        req_level = constraints['job_level']
-                        
-                        # Strong penalty for mismatched levels
-                        if req_level == 'Entry_Level' and cand_level == 'Manager_Senior':
-                            job_level_penalty = -3.0
-                        elif req_level == 'Manager_Senior' and cand_level == 'Entry_Level':
-                            job_level_penalty = -3.0
-                        # General level or matching level gets no penalty
-                    
-                    # Total boost with penalty
-                    total_boost = keyword_boost + name_boost + job_level_penalty
-                    boosted_score = score + total_boost
-                    
-                    boosted_scores.append(boosted_score)
+                # Keyword overlap with the document and with the assessment name
+                doc_overlap = np.fromiter(
+                    (len(query_keywords.intersection(docs[idx].lower().split())) for idx in candidates),
+                    dtype=np.float64, count=len(scores)
+                )
+                name_overlap = np.fromiter(
+                    (len(query_keywords.intersection(metas[idx].get('name', '').lower().split())) for idx in candidates),
+                    dtype=np.float64, count=len(scores)
+                )
+                num_keywords = len(query_keywords) or 1  # Overlaps are 0 when there are no keywords
                 
-                # Combine meta, doc, and boosted score
-                ranked_candidates = []
-                for idx, score in enumerate(boosted_scores):
-                    ranked_candidates.append({
-                        "meta": metas[idx],
-                        "score": score,
-                        "original_score": scores[idx],
-                        "boost": boosted_scores[idx] - scores[idx]
-                    })
+                # Moderate boost based on keyword overlap (up to +3.0), higher
+                # boost for name matches (up to +5.0)
+                boosts = (doc_overlap / num_keywords) * 3.0 + (name_overlap / num_keywords) * 5.0
                 
-                # Sort by boosted score descending
-                ranked_candidates.sort(key=lambda x: x["score"], reverse=True)
+                # ✅ Apply job level penalty instead of hard filtering
+                req_level = constraints.get('job_level')
+                if req_level in ('Entry_Level', 'Manager_Senior'):
+                    # Strong penalty for mismatched levels; General or matching level gets none
+                    mismatched_level = 'Manager_Senior' if req_level == 'Entry_Level' else 'Entry_Level'
+                    cand_levels = np.array([metas[idx].get('job_level', 'General') for idx in candidates], dtype=object)
+                    boosts -= 3.0 * (cand_levels == mismatched_level)
                 
-                # Filter by score threshold instead of forcing top N
-                filtered_results = [
-                    x for x in ranked_candidates 
-                    if x["score"] >= self.score_threshold
-                ]
+                boosted_scores = scores + boosts
+                
+                # Sort by boosted score descending (stable, like list.sort) and
+                # filter by score threshold instead of forcing top N
+                order = np.argsort(-boosted_scores, kind='stable')
+                order = order[boosted_scores[order] >= self.score_threshold]
                 
                 # Limit to n_results after filtering
-                top_results = filtered_results[:n_results]
+                top_results = [
+                    {"meta": metas[idx], "score": boosted_scores[idx], "original_score": scores[idx], "boost": boosts[idx]}
+                    for idx in order[:n_results]
+                ]
                 
                 # Extract metas
                 final_metas = [x["meta"] for x in top_results]
@@ -529,17 +622,30 @@ class RAGRecommender:
                     "description": meta.get("description", ""),
                     "duration": meta.get("duration", 0),
                     "remote_support": meta.get("remote_support", "No"),
-                    "test_type": [meta.get("test_type", "General")] 
+                    "test_type": self._meta_test_types(meta)
                 }
                 recommendations.append(item)
                 
-            return recommendations
+            return recommendations, full_pipeline
             
         except Exception as e:
             log.error(f"Error during RAG recommendation: {e}")
             import traceback
             log.error(traceback.format_exc())
-            return []
+            return [], False
+
+    @staticmethod
+    def _meta_test_types(meta: Dict[str, Any]) -> List[str]:
+        """All test types stored with the vector, falling back to the single primary type"""
+        raw = meta.get("test_types")
+        if raw:
+            try:
+                test_types = json.loads(raw)
+                if isinstance(test_types, list) and test_types:
+                    return test_types
+            except (TypeError, ValueError):
+                pass
+        return [meta.get("test_type", "General")]
 
     def chat(self, message: str, history: List[Dict[str, str]] = []) -> str:
         """
@@ -565,3 +671,9 @@ class RAGRecommender:
         except Exception as e:
             log.error(f"Error during chat: {e}")
             return "I apologize, but I'm having trouble connecting to the AI service right now. Please try again."
+
+
+@lru_cache()
+def get_rag_recommender() -> RAGRecommender:
+    """Get the shared RAG recommender (embedding client, vector DB, reranker, BM25 index)"""
+    return RAGRecommender()
@@ -32,7 +32,7 @@ print(f"\nQuery: '{query}'")
 
 # Get embedding
 print("Generating embedding...")
-embedding = embed_service.encode(query, is_query=True).tolist()
+embedding = embed_service.encode(query, is_query=True)[0]  # float32 ndarray
 print(f"Embedding dimension: {len(embedding)}")
 
 # Search
@@ -36,58 +36,56 @@ model = SentenceTransformer(EMBEDDING_MODEL)
 print("✅ Model loaded")
 
 # Generate embeddings with weighted names
-batch_size = 16
+batch_size = 64
 total = len(assessments)
 
-print(f"\nGenerating embeddings with 3x weighted names (batches of {batch_size})...")
+print(f"\nGenerating embeddings with 3x weighted names...")
 
 updated_count = 0
 error_count = 0
 
-for i in tqdm(range(0, total, batch_size), desc="Processing"):
-    batch = assessments[i:i+batch_size]
-    
+
+def build_text(item):
     # Build text with TRIPLED assessment names for stronger matching
-    texts = []
-    for item in batch:
-        # TRIPLE the name to increase its weight in embeddings
-        name = item['name']
-        parts = [name, name, name]  # Name appears 3 times
-        
-        desc = item.get('description', '')
-        if desc and desc != f"Assessment for {name}":
-            parts.append(desc[:150])
-        
-        if item.get('test_type') and item['test_type'] != 'General':
-            parts.append(f"Type: {item['test_type']}")
-        
-        if item.get('job_level') and item['job_level'] != 'General':
-            parts.append(f"Level: {item['job_level']}")
-        
-        if item.get('duration', 0) > 0:
-            parts.append(f"{item['duration']}min")
-        
-        texts.append('. '.join(parts))
+    name = item['name']
+    parts = [name, name, name]  # Name appears 3 times
+    
+    desc = item.get('description', '')
+    if desc and desc != f"Assessment for {name}":
+        parts.append(desc[:150])
+    
+    if item.get('test_type') and item['test_type'] != 'General':
+        parts.append(f"Type: {item['test_type']}")
+    
+    if item.get('job_level') and item['job_level'] != 'General':
+        parts.append(f"Level: {item['job_level']}")
     
-    # Generate embeddings
+    if item.get('duration', 0) > 0:
+        parts.append(f"{item['duration']}min")
+    
+    return '. '.join(parts)
+
+
+texts = [build_text(item) for item in assessments]
+
+# Encode everything in one call and let the model batch internally
+try:
+    vectors = model.encode(texts, batch_size=batch_size, normalize_embeddings=True, show_progress_bar=True)
+except Exception as e:
+    print(f"\n❌ Error generating embeddings: {e}")
+    sys.exit(1)
+
+# Update database
+for idx, item in enumerate(tqdm(assessments, desc="Updating")):
     try:
-        vectors = model.encode(texts, normalize_embeddings=True, show_progress_bar=False)
-        
-        # Update database
-        for idx, item in enumerate(batch):
-            try:
-                db.table('assessment_embeddings').update({
-                    'embedding': vectors[idx].tolist(),
-                    'full_text': texts[idx],
-                    'updated_at': time.strftime('%Y-%m-%dT%H:%M:%S')
-                }).eq('id', item['id']).execute()
-                updated_count += 1
-            except Exception as e:
-                error_count += 1
-        
+        db.table('assessment_embeddings').update({
+            'embedding': vectors[idx].tolist(),
+            'full_text': texts[idx],
+            'updated_at': time.strftime('%Y-%m-%dT%H:%M:%S')
+        }).eq('id', item['id']).execute()
+        updated_count += 1
     except Exception as e:
-        print(f"\n❌ Error in batch {i//batch_size + 1}: {e}")
-        error_count += len(batch)
+        error_count += 1
 
 print(f"\n{'='*80}")
 print("COMPLETE")
@@ -192,6 +192,9 @@ class SupabaseMigration:
         if assessment.get('description'):
             parts.append(f"Description: {assessment['description']}")
         
+        if assessment.get('test_types'):
+            parts.append(f"Test Types: {', '.join(assessment['test_types'])}")
+        
         if assessment.get('skills'):
             parts.append(f"Skills: {', '.join(assessment['skills'])}")
         
@@ -224,12 +227,17 @@ class SupabaseMigration:
             
             print(f"\n📦 Processing batch {batch_num}/{total_batches} ({len(batch)} assessments)...")
             
+            # Check which assessments already exist - one query per batch, not per assessment
+            try:
+                existing = self.client.table('assessments').select('id').in_('id', [a['id'] for a in batch]).execute()
+                existing_ids = {row['id'] for row in existing.data or []}
+            except Exception as e:
+                print(f"  ⚠️  Existence check failed, inserting all: {e}")
+                existing_ids = set()
+            
             for assessment in batch:
                 try:
-                    # Check if assessment already exists
-                    existing = self.client.table('assessments').select('id').eq('id', assessment['id']).execute()
-                    
-                    if existing.data:
+                    if assessment['id'] in existing_ids:
                         print(f"  ⏭️  Skipping {assessment['id']} (already exists)")
                         total_skipped += 1
                         continue
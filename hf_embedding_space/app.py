@@ -2,6 +2,7 @@ from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 from sentence_transformers import SentenceTransformer
 from typing import List, Union, Optional
+import os
 import uvicorn
 
 app = FastAPI(
@@ -10,8 +11,29 @@ app = FastAPI(
     version="2.0.0"
 )
 
+# Inference backend: "torch" (default) or "onnx" (ONNX Runtime, faster on CPU;
+# needs sentence-transformers>=3.2 with the onnx extra installed)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch").lower()
+
+
+def load_model() -> SentenceTransformer:
+    """Load the BGE model on the configured backend, falling back to torch"""
+    if EMBEDDING_BACKEND == "onnx":
+        try:
+            return SentenceTransformer('BAAI/bge-small-en-v1.5', backend="onnx")
+        except Exception as e:
+            print(f"ONNX backend unavailable, using torch: {e}")
+    
+    import torch
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    torch_model = SentenceTransformer('BAAI/bge-small-en-v1.5', device=device)
+    if device == "cuda":
+        torch_model.half()  # FP16 weights/activations on GPU; outputs are cast back to float32
+    return torch_model
+
+
 # Load BGE model once at startup - better for semantic search
-model = SentenceTransformer('BAAI/bge-small-en-v1.5')
+model = load_model()
 
 # BGE model instruction prefix for queries
 QUERY_PREFIX = "Represent this sentence for searching relevant passages: "
@@ -45,7 +67,7 @@ def root():
 
 @app.get("/health")
 def health_check():
-    return {"status": "healthy", "model_loaded": True, "model": "BAAI/bge-small-en-v1.5"}
+    return {"status": "healthy", "model_loaded": True, "model": "BAAI/bge-small-en-v1.5", "backend": getattr(model, "backend", "torch")}
 
 @app.post("/embed", response_model=EmbeddingResponse)
 def create_embeddings(request: EmbeddingRequest):
@@ -61,11 +83,12 @@ def create_embeddings(request: EmbeddingRequest):
         embeddings = model.encode(
             texts,
             normalize_embeddings=request.normalize,
-            show_progress_bar=False
+            show_progress_bar=False,
+            convert_to_numpy=True
         )
         
-        # Convert to list format
-        embeddings_list = embeddings.tolist()
+        # Convert to list format (float32, so FP16 GPU output serializes the same)
+        embeddings_list = embeddings.astype("float32", copy=False).tolist()
         
         return EmbeddingResponse(
             embeddings=embeddings_list,
@@ -115,7 +115,7 @@ def ingest():
         
     collection = client.create_collection(
         name=COLLECTION_NAME,
-        metadata={"hnsw:space": "cosine"}
+        metadata={"hnsw:space": "ip"}  # Embeddings are normalized below, so inner product ranks like cosine
     )
     
     print(f"Loading embedding model: {EMBEDDING_MODEL}")
@@ -141,7 +141,8 @@ def ingest():
             "description": item["description"][:1000]
         } for item in batch]
         
-        embeddings = model.encode(documents, normalize_embeddings=True).tolist()
+        # float32 ndarray straight to Chroma - no list-of-floats round trip
+        embeddings = model.encode(documents, normalize_embeddings=True, convert_to_numpy=True).astype("float32", copy=False)
         
         collection.add(
             ids=ids,